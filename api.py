@@ -1,60 +1,215 @@
-import requests
+import logging
+import os
+import random
 import sys
+import threading
 import time
+import metrics
+
+
+DEFAULT_POOL_SIZE = 10
+
+#connect and read timeouts, in seconds
+DEFAULT_TIMEOUT = (10, 60)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size = DEFAULT_POOL_SIZE):
+    #one pooled session per process, so connections are kept alive and
+    #reused by every client
+    global _session
+    with _session_lock:
+        if _session is not None:
+            return _session
+        #imported here, so that commands not calling the api don't load it
+        import requests
+        import requests.adapters
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        _session = session
+    return _session
+
+
+class RateLimiter(object):
+    #keeps track of the strava quotas (15 minutes and daily windows) using
+    #the rate limit headers, and waits only when the quota is exhausted. A
+    #window is enforced only once its limit has been read from the headers
+
+    #window lengths in seconds; windows start at quarter hours and midnight utc
+    WINDOWS = (15 * 60, 24 * 60 * 60)
+    #requests left unused in every window, in case of other clients
+    RESERVE = 1
+    MAX_BACKOFF = 60
+    #longer waits (i.e. for the daily quota) fail instead, in seconds
+    MAX_WAIT = 15 * 60
+
+    def __init__(self, min_interval = None):
+        self._min_interval = min_interval
+        self._limits = [None] * len(RateLimiter.WINDOWS)
+        self._usage = [0] * len(RateLimiter.WINDOWS)
+        self._windows = self._current_windows(time.time())
+        self._last_request = None
+        self._lock = threading.Lock()
+
+    def _current_windows(self, now):
+        return [int(now // length) for length in RateLimiter.WINDOWS]
+
+    def _refresh(self, now):
+        windows = self._current_windows(now)
+        for i, window in enumerate(windows):
+            if window != self._windows[i]:
+                self._usage[i] = 0
+        self._windows = windows
+
+    def _wait_time(self, now):
+        wait = 0
+        for i, length in enumerate(RateLimiter.WINDOWS):
+            if self._limits[i] is not None and self._usage[i] + RateLimiter.RESERVE >= self._limits[i]:
+                wait = max(wait, (self._windows[i] + 1) * length - now)
+        if wait > RateLimiter.MAX_WAIT:
+            raise ValueError("Strava rate limit reached, try again in {:.0f} minutes".format(wait / 60))
+        if self._min_interval is not None and self._last_request is not None:
+            wait = max(wait, self._last_request + self._min_interval - now)
+        return wait
+
+    def _sleep(self, seconds):
+        metrics.count('api.sleep_seconds', seconds)
+        print('sleep {:.1f}'.format(seconds), file=sys.stderr)
+        time.sleep(seconds)
+
+    def acquire(self):
+        with self._lock:
+            while True:
+                now = time.time()
+                self._refresh(now)
+                wait = self._wait_time(now)
+                if wait <= 0:
+                    break
+                self._sleep(wait)
+            for i in range(len(self._usage)):
+                self._usage[i] += 1
+            self._last_request = now
+
+    def _parse_header(self, value):
+        try:
+            return [int(v) for v in value.split(',')]
+        except ValueError:
+            return None
+
+    def update(self, headers):
+        limits = self._parse_header(headers.get('X-RateLimit-Limit', ''))
+        usage = self._parse_header(headers.get('X-RateLimit-Usage', ''))
+        if not limits or not usage:
+            return
+        with self._lock:
+            self._refresh(time.time())
+            for i in range(min(len(RateLimiter.WINDOWS), len(limits), len(usage))):
+                self._limits[i] = limits[i]
+                #requests still in flight are accounted locally as well
+                self._usage[i] = max(self._usage[i], usage[i])
+
+    def backoff(self, attempt, retry_after = None):
+        if retry_after is not None and retry_after.isdigit():
+            delay = int(retry_after) + random.uniform(0, 1)
+        else:
+            delay = random.uniform(0, min(RateLimiter.MAX_BACKOFF, 2 ** attempt))
+        logging.getLogger('RateLimiter').info(
+            "Retrying in {:.1f} seconds (attempt {})".format(delay, attempt + 1))
+        self._sleep(delay)
 
 
 class Client(object):
 
-    def __init__(self, token, sleep_time = None):
+    #can point to a mock server, see benchmarks/suite.py
+    BASE_URL = os.environ.get('STRAVA_CLI_API_URL', 'https://www.strava.com/api/v3')
+
+    MAX_RETRIES = 5
+
+    def __init__(self, token, sleep_time = None, pool_size = DEFAULT_POOL_SIZE,
+                 timeout = DEFAULT_TIMEOUT, base_url = BASE_URL):
+        self._token = token
+        self._rate_limiter = RateLimiter(sleep_time)
+        #created by the first request, so that requests is only loaded by
+        #the commands calling the api
+        self._session = None
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._base_url = base_url
+
+    def set_token(self, token):
         self._token = token
-        self._sleep_time = sleep_time
 
     def _get_headers(self):
         return {"Authorization": "Bearer {}".format(self._token)}
 
+    def _transferred_bytes(self, r):
+        #size of the body as received, before it is decompressed
+        try:
+            return r.raw.tell()
+        except (AttributeError, OSError):
+            return int(r.headers.get('Content-Length', len(r.content)))
+
+    def _request(self, method, url, data = None):
+        #retries on rate limiting and server errors
+        if self._session is None:
+            self._session = get_session(self._pool_size)
+        for attempt in range(Client.MAX_RETRIES + 1):
+            self._rate_limiter.acquire()
+            start = time.perf_counter()
+            r = self._session.request(method, self._base_url + url, data=data,
+                                      headers=self._get_headers(), timeout=self._timeout)
+            if metrics.enabled():
+                metrics.api_call(method, url, self._transferred_bytes(r), time.perf_counter() - start)
+            self._rate_limiter.update(r.headers)
+            if r.status_code != 429 and r.status_code < 500:
+                break
+            if attempt < Client.MAX_RETRIES:
+                metrics.count('api.retries')
+                self._rate_limiter.backoff(attempt, r.headers.get('Retry-After'))
+        return r
+
     def _get(self, url):
-        r = requests.get(url, headers=self._get_headers())
-        self._sleep()
+        r = self._request('GET', url)
         if r.status_code != 200:
             raise ValueError(r.text)
         return r.json()
 
     def _put(self, url, data):
-        r = requests.put(url, data, headers=self._get_headers())
-        self._sleep()
+        r = self._request('PUT', url, data)
         if r.status_code != 200:
-            raise ValueError()
+            raise ValueError(r.text)
 
     def update_activity(self, id, **kwargs):
-        self._put("https://www.strava.com/api/v3/activities/{}".format(id),
-                  dict(kwargs))
+        self._put("/activities/{}".format(id), dict(kwargs))
 
     def get_activities_page(self, page, per_page):
         return self._get(
-            "https://www.strava.com/api/v3/athlete/activities" +
-            "?page={}&per_page={}".format(page, per_page))
+            "/athlete/activities?page={}&per_page={}".format(page, per_page))
 
     def get_activities_after(self, seconds_from_epoch, page, per_page):
         activities = self._get(
-            "https://www.strava.com/api/v3/athlete/activities" +
-            "?after={}&page={}&per_page={}".format(
+            "/athlete/activities?after={}&page={}&per_page={}".format(
                                         seconds_from_epoch, page, per_page))
         return activities
 
+    def get_activities_between(self, after, before, page, per_page):
+        url = "/athlete/activities?after={}&page={}&per_page={}".format(after, page, per_page)
+        if before is not None:
+            url += "&before={}".format(before)
+        return self._get(url)
+
     def get_activity_detail(self, id):
-        return self._get(
-            "https://www.strava.com/api/v3/activities/{}".format(id))
+        return self._get("/activities/{}".format(id))
 
-    def get_streams(self, id, stream_types = ['time','latlng','altitude']):
+    def get_streams(self, id, stream_types = ('time','latlng','altitude')):
         return self._get(
-            "https://www.strava.com/api/v3/activities/{}/streams?keys={}&key_by_type=true".format(id, ','.join(stream_types)))
+            "/activities/{}/streams?keys={}&key_by_type=true".format(id, ','.join(stream_types)))
 
     def get_athlete(self):
-        return self._get("https://www.strava.com/api/v3/athlete")
-    
-    def _sleep(self):
-        #used because of throttling strava api
-        if self._sleep_time is not None:
-            print('sleep {}'.format(self._sleep_time), file=sys.stderr)
-            time.sleep(self._sleep_time)
-
+        return self._get("/athlete")
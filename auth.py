@@ -2,8 +2,6 @@ import os.path
 import config
 import json
 import util
-from flask import Flask, redirect, request, abort
-import requests
 import logging
 import time
 
@@ -47,10 +45,12 @@ class Authorizer:
         self._store = store
 
     def index(self):
+        from flask import redirect
         return redirect(Authorizer.AUTH_URL_TEMPLATE.format(
                             self._client_id, self._port), 302)
 
     def get_token(self):
+        from flask import request, abort
         if 'error' in request.args:
             return abort(401)
         if 'code' in request.args:
@@ -66,6 +66,9 @@ class Authorizer:
     def authorize(self, client_id, client_secret):
         self._client_id = client_id
         self._client_secret = client_secret
+        #flask is only needed to authenticate, so it's not loaded by the
+        #other commands
+        from flask import Flask
         app = Flask(__name__)
         app.add_url_rule('/', 'index', self.index)
         app.add_url_rule('/token', 'get_token', self.get_token)
@@ -105,6 +108,7 @@ class TokenRefresher:
             data[TokenRefresher.REFRESH_TOKEN] = refresh_token
         if code:
             data[TokenRefresher.CODE] = code
+        import requests
         response = requests.post(TokenRefresher.TOKEN_URL, data=data)
         d = response.json()
         if TokenRefresher.ACCESS_TOKEN in d:
@@ -119,10 +123,17 @@ class AccessTokenProvider:
 
     def __init__(self, store):
         self._store = store
+        self._auth = None
 
     def get_access_token(self):
-        auth = self._store.load_auth()
+        #the stored token is read once, and again only when it expires
+        auth = self._auth
+        if auth is None or time.time() >= auth[TokenRefresher.EXPIRES_AT]:
+            auth = self._store.load_auth()
+        if auth is None:
+            return None
         if time.time() < auth[TokenRefresher.EXPIRES_AT]:
+            self._auth = auth
             return auth[TokenRefresher.ACCESS_TOKEN]
         refresher = TokenRefresher(auth[TokenRefresher.CLIENT_ID], auth[TokenRefresher.CLIENT_SECRET])
         auth = refresher.refresh(
@@ -130,6 +141,7 @@ class AccessTokenProvider:
         if not auth:
             return None
         self._store.save_auth(auth)
+        self._auth = auth
         return auth[TokenRefresher.ACCESS_TOKEN]
 
 
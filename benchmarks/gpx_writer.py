@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+#Compares formatters.GpxFormatter with the gpxpy object tree it replaced,
+#on a synthetic track; gpxpy is only needed to run this benchmark.
+#
+#   ./benchmarks/gpx_writer.py [points]
+
+import datetime
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import formatters
+import gpxpy
+import gpxpy.gpx
+import tracks
+
+
+def gpxpy_format(activity, gps):
+    gpx = gpxpy.gpx.GPX()
+    gpx_track = gpxpy.gpx.GPXTrack(name=activity.get('name'))
+    gpx_track.type = activity.get('type')
+    gpx_track.comment = str(activity.get('id'))
+    gpx.tracks.append(gpx_track)
+    gpx_segment = gpxpy.gpx.GPXTrackSegment()
+    gpx_track.segments.append(gpx_segment)
+    for point_time, point, altitude in gps:
+        point_time = datetime.datetime.fromtimestamp(point_time, datetime.timezone.utc)
+        gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(
+            latitude=point[0], longitude=point[1], elevation=altitude, time=point_time))
+    return gpx.to_xml(prettyprint=True)
+
+
+def synthetic_track(points):
+    latitude, longitude, altitude = 45.0, 9.0, 200.0
+    latlng = []
+    altitudes = []
+    for i in range(points):
+        latitude += random.uniform(-0.0001, 0.0001)
+        longitude += random.uniform(-0.0001, 0.0001)
+        altitude += random.uniform(-1, 1)
+        latlng.append([round(latitude, 6), round(longitude, 6)])
+        altitudes.append(round(altitude, 1))
+    streams = {'time': {'data': list(range(points))}, 'latlng': {'data': latlng},
+               'altitude': {'data': altitudes}}
+    return tracks.GpsTrack.from_streams(1600000000, streams)
+
+
+def measure(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main():
+    points = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    activity = {'id': 1, 'name': 'Morning Ride', 'type': 'Ride'}
+    gps = list(synthetic_track(points))
+    gpxpy_time, expected = measure(lambda: gpxpy_format(activity, gps))
+    writer_time, output = measure(lambda: formatters.GpxFormatter().format(activity, gps))
+    print('points:          {}'.format(points))
+    print('gpxpy:           {:.3f} s'.format(gpxpy_time))
+    print('streaming:       {:.3f} s'.format(writer_time))
+    print('same output:     {}'.format(output == expected))
+
+
+if __name__ == '__main__':
+    main()
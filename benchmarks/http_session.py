@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+#Compares the per-request latency of one-off requests against the pooled
+#session used by api.Client, using a local mock of the activity endpoint.
+#
+#   ./benchmarks/http_session.py [requests]
+
+import http.server
+import json
+import os.path
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api
+import requests
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({'id': 1, 'name': 'Morning Ride'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(fn, count):
+    start = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    return (time.perf_counter() - start) / count * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server = start_server()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    client = api.Client('token', base_url=base_url)
+    unpooled = measure(lambda i: requests.get(base_url + '/activities/{}'.format(i)).json(), count)
+    pooled = measure(lambda i: client.get_activity_detail(i), count)
+    print('requests.get:   {:.3f} ms/request'.format(unpooled))
+    print('pooled session: {:.3f} ms/request'.format(pooled))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
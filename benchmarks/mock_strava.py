@@ -0,0 +1,260 @@
+#Local mock of the Strava api used by the benchmarks: serves a synthetic
+#athlete (activities, details, streams and updates) with rate limit headers.
+
+import bisect
+import datetime
+import http.server
+import json
+import math
+import os.path
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import polyline
+
+PREFIX = '/api/v3'
+
+TYPES = ('Ride', 'Run', 'Walk', 'Hike', 'Swim', 'VirtualRide')
+
+#words of the activity names and descriptions
+TIMES = ('Morning', 'Lunch', 'Afternoon', 'Evening', 'Night')
+PLACES = ('lake', 'hills', 'river', 'park', 'coast', 'pass', 'forest', 'city', 'valley', 'track')
+
+#the activities are spread over this many seconds, ending yesterday
+SPAN = 10 * 365 * 24 * 60 * 60
+
+#returned in the X-RateLimit-Limit header, high enough not to throttle
+RATE_LIMITS = (100000, 1000000)
+
+#summary polylines: loops of ROUTE_POINTS points, with ROUTE_SHAPES shapes
+ROUTE_POINTS = 150
+ROUTE_SHAPES = 64
+
+
+def format_date(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Athlete(object):
+    #synthetic athlete with count activities (ids from 1, oldest first) and
+    #gps streams of points points per activity
+
+    def __init__(self, count, points = 3600, seed = 0):
+        self._random = random.Random(seed)
+        self._points = points
+        self._lock = threading.Lock()
+        end = int(time.time()) - 24 * 60 * 60
+        self._step = max(60, SPAN // max(count, 1))
+        self._start = end - self._step * count
+        self._activities = []
+        self._dates = []
+        self._routes = [self._route() for _ in range(ROUTE_SHAPES)]
+        self.add(count)
+
+    def _route(self):
+        #encoded deltas of a loop from the start point (in 1e-5 degrees, so
+        #that they don't depend on it); the start point is prepended later
+        radius = self._random.randint(500, 5000)
+        offsets = [(0, 0)] + [(round(radius * math.sin(2 * math.pi * i / ROUTE_POINTS)) / 10 ** 5,
+                               round(radius * (math.cos(2 * math.pi * i / ROUTE_POINTS) - 1)) / 10 ** 5)
+                              for i in range(1, ROUTE_POINTS)]
+        return polyline.encode(offsets)[len(polyline.encode([(0, 0)])):]
+
+    def _activity(self, id, start):
+        distance = round(self._random.uniform(1000, 100000), 1)
+        moving_time = int(distance / self._random.uniform(2, 10))
+        activity_type = self._random.choice(TYPES)
+        latitude = round(45.0 + self._random.uniform(-1, 1), 5)
+        longitude = round(9.0 + self._random.uniform(-1, 1), 5)
+        route = polyline.encode([(latitude, longitude)]) + self._random.choice(self._routes)
+        return {
+            'id': id,
+            'name': '{} {} by the {}'.format(
+                self._random.choice(TIMES), activity_type, self._random.choice(PLACES)),
+            'type': activity_type,
+            'start_date': format_date(start),
+            'start_date_local': format_date(start + 3600),
+            'timezone': '(GMT+01:00) Europe/Rome',
+            'utc_offset': 3600.0,
+            'distance': distance,
+            'moving_time': moving_time,
+            'elapsed_time': moving_time + self._random.randint(0, 1800),
+            'total_elevation_gain': round(self._random.uniform(0, 2000), 1),
+            'average_speed': round(distance / moving_time, 3),
+            'trainer': self._random.random() < 0.1,
+            'commute': self._random.random() < 0.1,
+            'private': self._random.random() < 0.2,
+            'gear_id': 'b{}'.format(self._random.randint(1, 3)),
+            'kudos_count': self._random.randint(0, 50),
+            'start_latlng': [latitude, longitude],
+            'map': {'id': 'a{}'.format(id), 'summary_polyline': route, 'resource_state': 2},
+            'resource_state': 2,
+        }
+
+    def add(self, count):
+        #adds count activities after the existing ones
+        with self._lock:
+            for _ in range(count):
+                id = len(self._activities) + 1
+                start = self._start + self._step * id
+                self._activities.append(self._activity(id, start))
+                self._dates.append(start)
+
+    def __len__(self):
+        return len(self._activities)
+
+    def ids(self):
+        return [activity['id'] for activity in self._activities]
+
+    def activities(self, after = None, before = None):
+        #newest first, or oldest first when after is set, as strava does
+        with self._lock:
+            lower = bisect.bisect_right(self._dates, after) if after is not None else 0
+            upper = bisect.bisect_left(self._dates, before) if before is not None else len(self._dates)
+            activities = self._activities[lower:upper]
+        return activities if after is not None else activities[::-1]
+
+    def get(self, id):
+        if 1 <= id <= len(self._activities):
+            return self._activities[id - 1]
+        return None
+
+    def detail(self, id):
+        activity = self.get(id)
+        if activity is None:
+            return None
+        detail = dict(activity, resource_state=3)
+        detail.update({
+            'description': 'Around the {} with friends, activity {}'.format(PLACES[id % len(PLACES)], id),
+            'calories': round(activity['distance'] / 30, 1),
+            'device_name': 'Garmin Edge 530',
+            'segment_efforts': [],
+            'splits_metric': [{'distance': 1000.0, 'split': split} for split in range(1, 11)],
+        })
+        return detail
+
+    def update(self, id, data):
+        activity = self.get(id)
+        if activity is None:
+            return None
+        with self._lock:
+            for k, v in data.items():
+                if k in activity:
+                    activity[k] = v
+        return activity
+
+    def streams(self, id, keys):
+        activity = self.get(id)
+        if activity is None:
+            return None
+        latitude, longitude = activity['start_latlng']
+        data = {
+            'time': list(range(self._points)),
+            'latlng': [[round(latitude + 0.001 * math.sin(i / 100), 6),
+                        round(longitude + 0.001 * math.cos(i / 100), 6)] for i in range(self._points)],
+            'altitude': [round(200 + 50 * math.sin(i / 300), 1) for i in range(self._points)],
+        }
+        return {key: {'data': data[key], 'series_type': 'distance', 'original_size': self._points,
+                      'resolution': 'high'} for key in keys if key in data}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _send(self, status, value):
+        body = json.dumps(value).encode('utf-8')
+        server = self.server
+        with server.lock:
+            server.usage += 1
+            usage = server.usage
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Limit', ','.join(str(limit) for limit in RATE_LIMITS))
+        self.send_header('X-RateLimit-Usage', '{},{}'.format(usage, usage))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, endpoint):
+        with self.server.lock:
+            self.server.requests[endpoint] = self.server.requests.get(endpoint, 0) + 1
+
+    def _parse(self):
+        url = urllib.parse.urlparse(self.path)
+        path = url.path[len(PREFIX):] if url.path.startswith(PREFIX) else url.path
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        return path.strip('/').split('/'), query
+
+    def do_GET(self):
+        athlete = self.server.athlete
+        parts, query = self._parse()
+        if parts == ['athlete', 'activities']:
+            self._count('activities')
+            page = int(query.get('page', 1))
+            per_page = int(query.get('per_page', 30))
+            activities = athlete.activities(
+                int(query['after']) if 'after' in query else None,
+                int(query['before']) if 'before' in query else None)
+            return self._send(200, activities[(page - 1) * per_page:page * per_page])
+        if parts == ['athlete']:
+            self._count('athlete')
+            return self._send(200, {'id': 1, 'bikes': [], 'shoes': []})
+        if len(parts) == 2 and parts[0] == 'activities' and parts[1].isdigit():
+            self._count('detail')
+            detail = athlete.detail(int(parts[1]))
+            return self._send(200, detail) if detail is not None else self._send(404, {'message': 'Not Found'})
+        if len(parts) == 3 and parts[0] == 'activities' and parts[2] == 'streams':
+            self._count('streams')
+            streams = athlete.streams(int(parts[1]), query.get('keys', '').split(','))
+            return self._send(200, streams) if streams is not None else self._send(404, {'message': 'Not Found'})
+        self._send(404, {'message': 'Not Found'})
+
+    def do_PUT(self):
+        parts, _ = self._parse()
+        length = int(self.headers.get('Content-Length', 0))
+        data = {k: v[-1] for k, v in urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        if len(parts) == 2 and parts[0] == 'activities' and parts[1].isdigit():
+            self._count('update')
+            activity = self.server.athlete.update(int(parts[1]), data)
+            return self._send(200, activity) if activity is not None else self._send(404, {'message': 'Not Found'})
+        self._send(404, {'message': 'Not Found'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockStrava(object):
+
+    def __init__(self, athlete):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.athlete = athlete
+        server.lock = threading.Lock()
+        server.usage = 0
+        server.requests = {}
+        self._server = server
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}{}'.format(self._server.server_address[1], PREFIX)
+
+    def requests(self):
+        #requests per endpoint since the last call
+        with self._server.lock:
+            requests = self._server.requests
+            self._server.requests = {}
+        return requests
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+#Startup time budget of the command line: runs strava-cli.py with
+#python -X importtime, printing the help and listing a small cached athlete
+#without calling the api, and fails (exit code 1) if the modules it loads
+#take longer than the budget, or if it loads modules that only some
+#commands need (flask, requests, sqlite3, ...).
+#
+#   ./benchmarks/startup.py [budget in ms]
+
+import json
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+BUDGET_MS = 50
+RUNS = 5
+
+#commands measured; the second one reads the cache but makes no api call
+COMMANDS = (['-h'], ['--no-daemon', 'activities', '--update-cache', 'false'])
+
+#modules that must be imported only by the commands using them
+LAZY_MODULES = ('flask', 'requests', 'sqlite3', 'gpxpy', 'concurrent.futures', 'http.client')
+
+
+def create_home(home):
+    #token and json cache of one activity
+    directory = os.path.join(home, '.strava-cli')
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'auth.json'), 'w') as outfile:
+        json.dump({'access_token': 'token', 'refresh_token': 'token',
+                   'expires_at': time.time() + 365 * 24 * 60 * 60}, outfile)
+    activity = {'id': 1, 'name': 'Morning Ride', 'type': 'Ride', 'start_date': '2020-01-01T08:00:00Z',
+                'start_date_local': '2020-01-01T09:00:00Z', 'distance': 10000.0, 'moving_time': 1800,
+                'elapsed_time': 2000, 'total_elevation_gain': 100.0}
+    with open(os.path.join(directory, 'activities.json'), 'w') as outfile:
+        json.dump({'activities': [activity]}, outfile)
+
+
+def import_times(argv, home):
+    #returns {module: cumulative microseconds} for the modules imported at
+    #the top level, excluding the interpreter startup (site)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', os.path.join(ROOT, 'strava-cli.py')] + argv,
+        env=dict(os.environ, HOME=home), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    modules = {}
+    in_site = True
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line.split(':', 1)[1].split('|')
+        top_level = not name.startswith('  ')
+        module = name.strip()
+        if in_site:
+            #everything up to the site module is interpreter startup
+            in_site = not (top_level and module == 'site')
+            continue
+        modules[module] = (int(cumulative), top_level)
+    return modules
+
+
+def check(argv, home, budget):
+    #returns True if the command is within the budget
+    runs = [import_times(argv, home) for i in range(RUNS)]
+    totals = sorted(sum(cumulative for cumulative, top_level in modules.values() if top_level) / 1000
+                    for modules in runs)
+    median = totals[len(totals) // 2]
+    loaded = [module for module in LAZY_MODULES if module in runs[0]]
+    print('{}: import time {:.1f} ms (budget {:.1f} ms)'.format(' '.join(argv), median, budget))
+    if loaded:
+        print('modules that should be loaded lazily: {}'.format(', '.join(loaded)))
+    return median <= budget and not loaded
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS
+    with tempfile.TemporaryDirectory() as home:
+        create_home(home)
+        results = [check(argv, home, budget) for argv in COMMANDS]
+    if not all(results):
+        print('FAILED')
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
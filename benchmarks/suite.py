@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+#Runs the command line against a local mock of the Strava api, with
+#synthetic athletes of different sizes, and stores the timings as JSON so
+#that runs on different commits can be compared. Every command runs in a new
+#process (as a user would run it) with an isolated home directory.
+#
+#   ./benchmarks/suite.py [--sizes 1000,10000,100000] [--output results.json]
+#   ./benchmarks/suite.py --compare base.json results.json
+
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, '..')
+
+sys.path.insert(0, BENCHMARKS)
+
+import mock_strava
+
+#activities uploaded before the incremental sync
+NEW_ACTIVITIES = 10
+#activities used by the details, gps and update commands
+DETAIL_IDS = 50
+GPS_IDS = 10
+
+#slower than this (relative to the base run) is reported as a regression
+THRESHOLD = 0.1
+
+
+class Runner(object):
+    #runs the command line in a temporary home directory, against the mock
+
+    def __init__(self, server, home, jobs):
+        self._server = server
+        self._home = home
+        self._jobs = jobs
+        directory = os.path.join(home, '.strava-cli')
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'auth.json'), 'w') as outfile:
+            json.dump({'access_token': 'token', 'refresh_token': 'token',
+                       'expires_at': time.time() + 365 * 24 * 60 * 60}, outfile)
+
+    def run(self, *argv):
+        env = dict(os.environ, HOME=self._home, STRAVA_CLI_API_URL=self._server.url)
+        command = [sys.executable, os.path.join(ROOT, 'strava-cli.py'), '--no-daemon',
+                   '--jobs', str(self._jobs)] + list(argv)
+        self._server.requests()
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+        return time.perf_counter() - start, self._server.requests()
+
+
+def scenarios(athlete, backend):
+    #(name, repeatable, setup, argv); repeatable scenarios don't change the
+    #state, so they run several times and the best time is kept
+    ids = athlete.ids()
+    detail_ids = [str(id) for id in ids[-DETAIL_IDS:]]
+    gps_ids = [str(id) for id in ids[-GPS_IDS:]]
+    after = (datetime.date.today() - datetime.timedelta(days=365)).strftime('%Y%m%d')
+    result = [('cold_sync', False, None, ['activities', '-q'])]
+    if backend == 'sqlite':
+        result.append(('migrate_cache', False, None, ['migrate-cache']))
+    result += [
+        ('incremental_sync', False, lambda: athlete.add(NEW_ACTIVITIES), ['activities', '-q']),
+        ('list', True, None, ['activities']),
+        ('list_json', True, None, ['activities', '-j']),
+        ('filtered_list', True, None, ['activities', '-f', 'type=Ride', '-f', 'after={}'.format(after)]),
+        ('text_search', True, None, ['activities', '-f', 'name~=morning lake', '-f', 'type=Run']),
+        ('near_search', True, None, ['activities', '-f', 'near=45,9,10']),
+        ('export_geojson', True, None, ['export']),
+        ('export_gpx', True, None, ['export', '--format', 'gpx']),
+        ('stats', True, None, ['stats', '-g', 'month']),
+        ('details_cold', False, None, ['details'] + detail_ids),
+        ('details_warm', True, None, ['details'] + detail_ids),
+        ('gps_cold', False, None, ['gps'] + gps_ids),
+        ('gps_warm', True, None, ['gps'] + gps_ids),
+        ('gps_ndjson', True, None, ['gps', '--ndjson'] + gps_ids),
+        ('bulk_update', False, None, ['update', '--set', 'name=Renamed'] + detail_ids),
+        ('bulk_update_unchanged', True, None, ['update', '--set', 'name=Renamed'] + detail_ids),
+    ]
+    return result
+
+
+def run_size(size, options):
+    athlete = mock_strava.Athlete(size, options.points)
+    results = {}
+    with mock_strava.MockStrava(athlete) as server, tempfile.TemporaryDirectory() as home:
+        runner = Runner(server, home, options.jobs)
+        for name, repeatable, setup, argv in scenarios(athlete, options.backend):
+            if setup is not None:
+                setup()
+            runs = [runner.run(*argv) for _ in range(options.repeat if repeatable else 1)]
+            seconds, requests = min(runs, key=lambda run: run[0])
+            results[name] = {'seconds': round(seconds, 4), 'requests': requests}
+            print('{:>7} {:<22} {:8.3f} s  {}'.format(size, name, seconds, requests), file=sys.stderr)
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base_file, new_file):
+    #returns the number of regressions
+    with open(base_file) as infile:
+        base = json.load(infile)
+    with open(new_file) as infile:
+        new = json.load(infile)
+    print('{} -> {}'.format(base.get('commit'), new.get('commit')))
+    regressions = 0
+    for size, results in new['results'].items():
+        for name, result in results.items():
+            before = base['results'].get(size, {}).get(name)
+            if before is None:
+                continue
+            ratio = result['seconds'] / before['seconds'] if before['seconds'] else 1
+            regression = ratio > 1 + THRESHOLD
+            regressions += regression
+            print('{:>7} {:<22} {:8.3f} s {:8.3f} s {:6.2f}x{}'.format(
+                size, name, before['seconds'], result['seconds'], ratio, '  REGRESSION' if regression else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='strava-cli benchmark suite')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='Comma separated numbers of activities')
+    parser.add_argument('--points', type=int, default=10000,
+                        help='Points of every gps stream')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of the commands that don\'t change the cache')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='Value of the --jobs option of the command line')
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json',
+                        help='Cache backend')
+    parser.add_argument('--output', '-o', help='Results file (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='Compares two results files; fails if NEW has regressions')
+    options = parser.parse_args()
+    if options.compare:
+        sys.exit(1 if compare(*options.compare) else 0)
+    results = {
+        'commit': get_commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'options': {'points': options.points, 'repeat': options.repeat,
+                    'jobs': options.jobs, 'backend': options.backend},
+        'results': {size: run_size(int(size), options) for size in options.sizes.split(',')},
+    }
+    if options.output:
+        with open(options.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
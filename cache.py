@@ -3,6 +3,15 @@ import os.path
 import json
 import config
 import tempfile
+import contextlib
+import bisect
+import time
+import metrics
+import indexes
+import stats
+import tracks
+import util
+import logging
 
 
 class AbstractCache(object):
@@ -19,81 +28,704 @@ class AbstractCache(object):
     def get_activity(self, id):
         return next((activity for activity in self.get_activities() if activity['id'] == id), None)
 
+    def count_activities(self):
+        return len(self.get_activities())
+
+    def get_activities_by_ids(self, ids):
+        #sorted by utc date, newest first, like get_activities
+        ids = set(ids)
+        return [activity for activity in self.get_activities() if activity['id'] in ids]
+
     def update_activity_detail(self, activity_detail):
         raise NotImplementedError
 
     def get_activity_detail(self, id):
         raise NotImplementedError
 
+    def get_activity_details(self):
+        raise NotImplementedError
+
+    def clear_activity_details(self):
+        raise NotImplementedError
+
+    def merge_activities(self, new_activities):
+        #combine the two lists and make sure the new list is sorted by utc date
+        activities = self.get_activities()
+        activity_ids = {activity['id']: index for index, activity in enumerate(activities)}
+        for new_activity in new_activities:
+            id = new_activity['id']
+            if id in activity_ids:
+                activities[activity_ids[id]] = new_activity
+            else:
+                activities.append(new_activity)
+        self.update_activities(
+            sorted(activities, key=lambda activity: activity['start_date'], reverse=True))
+
+    def delete_activities(self, ids):
+        raise NotImplementedError
+
+    def find_activities(self, predicate):
+        #activities are sorted by start_date, newest first
+        return predicate.filter(self.get_activities())
+
+    def get_metadata(self, key, default = None):
+        raise NotImplementedError
+
+    def set_metadata(self, key, value):
+        raise NotImplementedError
+
+    def get_all_metadata(self):
+        #key -> value dict of every metadata entry
+        raise NotImplementedError
+
+    def refresh(self):
+        #drops what is kept in memory if another process changed the cache,
+        #returning True if it did
+        return False
+
+    @contextlib.contextmanager
+    def batch(self):
+        #changes made inside the block may be written just once at the end
+        yield
+
     def clear(self):
         raise NotImplementedError
 
 
-class JsonCache(AbstractCache):
+class ActivityIndex(object):
+
+    DATE_FIELDS = ('start_date', 'start_date_local')
+
+    def __init__(self, activities):
+        self._by_id = {}
+        #per date field: id -> indexed date and a sorted list of (date, id)
+        self._dates = {field: {} for field in ActivityIndex.DATE_FIELDS}
+        self._sorted = {}
+        for activity in activities:
+            self._by_id[activity['id']] = activity
+            for field in ActivityIndex.DATE_FIELDS:
+                self._dates[field][activity['id']] = activity.get(field) or ''
+        for field in ActivityIndex.DATE_FIELDS:
+            self._sorted[field] = sorted((date, id) for id, date in self._dates[field].items())
+
+    def get(self, id):
+        return self._by_id.get(id)
+
+    def update(self, activity):
+        id = activity['id']
+        self._by_id[id] = activity
+        for field in ActivityIndex.DATE_FIELDS:
+            date = activity.get(field) or ''
+            old_date = self._dates[field].get(id)
+            if old_date == date:
+                continue
+            entries = self._sorted[field]
+            if old_date is not None:
+                del entries[bisect.bisect_left(entries, (old_date, id))]
+            bisect.insort(entries, (date, id))
+            self._dates[field][id] = date
+
+    def between(self, field, after = None, before = None):
+        #ids of the activities with after < date < before, oldest first
+        entries = self._sorted[field]
+        start = bisect.bisect_right(entries, (after, float('inf'))) if after is not None else 0
+        end = bisect.bisect_left(entries, (before,)) if before is not None else len(entries)
+        return [id for date, id in entries[start:end]]
+
+
+class JsonCache(util.JsonDocument, AbstractCache):
+    #the whole cache is one json document, see util.JsonDocument for how
+    #concurrent commands share it
 
     def __init__(self, directory, file_name):
-        self._dir = directory
-        self._file = os.path.join(directory, file_name)
-        self._cache = None
+        super().__init__(os.path.join(directory, file_name))
+        self._index = None
 
     def _cache_file(self):
-        return self._file
+        return self._path
 
     def is_initialized(self):
         return os.path.exists(self._cache_file())
 
-    def _load_cache_from_file(self):
-        if not self.is_initialized():
-            return {}
-        with open(self._cache_file()) as json_data:
-            return json.load(json_data)
+    def _load(self):
+        with metrics.phase('cache_load'):
+            return super()._load()
+
+    def _reset(self):
+        self._index = None
 
     def _get_cache(self):
-        if self._cache is None:
-            self._cache = self._load_cache_from_file()
-        self._cache.setdefault('activities', [])
-        self._cache.setdefault('activity_details', {})
-        return self._cache
+        cache = self._get_document()
+        cache.setdefault('activities', [])
+        cache.setdefault('activity_details', {})
+        cache.setdefault('metadata', {})
+        return cache
 
-    def _update_cache(self, cache):
-        if not os.path.exists(self._dir):
-            os.makedirs(self._dir)
-        with tempfile.NamedTemporaryFile(dir=self._dir, mode='w') as outfile:
-            json.dump(cache, outfile)
-            #minor race case
-            if self.is_initialized():
-                os.remove(self._cache_file())
-            os.link(outfile.name, self._cache_file())
+    def _merge(self):
+        logging.getLogger('JsonCache').info("Cache changed by another process, merging {} changes".format(
+            len(self._pending)))
+        metrics.count('cache.merge')
+        super()._merge()
+
+    def _flush(self):
+        metrics.count('cache.flush')
+        with metrics.phase('cache_write'):
+            super()._flush()
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = ActivityIndex(self.get_activities())
+        return self._index
 
     def get_activities(self):
         return self._get_cache()['activities']
 
     def update_activities(self, activities):
+        self._change('_set_activities', activities)
+
+    def _set_activities(self, activities):
+        self._get_cache()['activities'] = activities
+        self._index = None
+
+    def merge_activities(self, new_activities):
+        self._change('_merge_activities', new_activities)
+
+    def _merge_activities(self, new_activities):
+        index = self._get_index()
+        activities = self.get_activities()
+        for new_activity in new_activities:
+            activity = index.get(new_activity['id'])
+            if activity is not None:
+                #replace in place, so the position in the list is kept
+                activity.clear()
+                activity.update(new_activity)
+            else:
+                activity = dict(new_activity)
+                activities.append(activity)
+            index.update(activity)
+        activities.sort(key=lambda activity: activity['start_date'], reverse=True)
+
+    def get_activity(self, id):
+        return self._get_index().get(id)
+
+    def get_activities_by_ids(self, ids):
+        index = self._get_index()
+        activities = [activity for activity in map(index.get, ids) if activity is not None]
+        activities.sort(key=lambda activity: activity['start_date'], reverse=True)
+        return activities
+
+    def delete_activities(self, ids):
+        self._change('_delete_activities', set(ids))
+
+    def _delete_activities(self, ids):
         cache = self._get_cache()
-        cache['activities'] = activities
-        self._update_cache(cache)
+        cache['activities'] = [activity for activity in cache['activities'] if activity['id'] not in ids]
+        for id in ids:
+            cache['activity_details'].pop(str(id), None)
+        self._index = None
 
     def update_activity(self, activity):
+        #a copy, as the caller may keep changing the activity
+        self._change('_update_activity', dict(activity))
+
+    def _update_activity(self, activity):
         a = self.get_activity(activity['id'])
         if a is not None:
             for k, v in activity.items():
                 a[k] = v
-        self._update_cache(self._get_cache())
+            self._get_index().update(a)
+
+    def find_activities(self, predicate):
+        bounds = {}
+        for name, operator, value in predicate.constraints():
+            if name not in ActivityIndex.DATE_FIELDS or operator not in ('>', '<'):
+                continue
+            after, before = bounds.get(name, (None, None))
+            if operator == '>':
+                after = value if after is None else max(after, value)
+            else:
+                before = value if before is None else min(before, value)
+            bounds[name] = (after, before)
+        if not bounds:
+            return super().find_activities(predicate)
+        field = 'start_date' if 'start_date' in bounds else 'start_date_local'
+        index = self._get_index()
+        candidates = [index.get(id) for id in reversed(index.between(field, *bounds[field]))]
+        if field != 'start_date':
+            candidates.sort(key=lambda activity: activity['start_date'], reverse=True)
+        return predicate.filter(candidates)
 
     def update_activity_detail(self, activity_detail):
-        cache = self._get_cache()
-        cache['activity_details'][activity_detail['id']] = activity_detail
-        self._update_cache(cache)
+        self._change('_update_activity_detail', activity_detail)
+
+    def _update_activity_detail(self, activity_detail):
+        self._get_cache()['activity_details'][str(activity_detail['id'])] = activity_detail
 
     def get_activity_detail(self, id):
         return self._get_cache()['activity_details'].get(str(id))
 
+    def get_activity_details(self):
+        return list(self._get_cache()['activity_details'].values())
+
+    def clear_activity_details(self):
+        self._change('_clear_activity_details')
+
+    def _clear_activity_details(self):
+        self._get_cache()['activity_details'] = {}
+
+    def get_metadata(self, key, default = None):
+        return self._get_cache()['metadata'].get(key, default)
+
+    def set_metadata(self, key, value):
+        self._change('_set_metadata', key, value)
+
+    def _set_metadata(self, key, value):
+        self._get_cache()['metadata'][key] = value
+
+    def get_all_metadata(self):
+        return dict(self._get_cache()['metadata'])
+
+    def clear(self):
+        self._delete_file()
+
+
+class SqliteCache(util.Batched, AbstractCache):
+
+    #columns extracted from the activity json so that they can be indexed
+    COLUMNS = ('id', 'start_date', 'start_date_local', 'type', 'trainer', 'private')
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT);
+        CREATE TABLE IF NOT EXISTS activities (
+            id INTEGER PRIMARY KEY,
+            start_date TEXT,
+            start_date_local TEXT,
+            type TEXT,
+            trainer INTEGER,
+            private INTEGER,
+            data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS activities_start_date ON activities (start_date);
+        CREATE INDEX IF NOT EXISTS activities_start_date_local ON activities (start_date_local);
+        CREATE INDEX IF NOT EXISTS activities_type ON activities (type);
+        CREATE INDEX IF NOT EXISTS activities_trainer ON activities (trainer);
+        CREATE INDEX IF NOT EXISTS activities_private ON activities (private);
+        CREATE TABLE IF NOT EXISTS activity_details (
+            id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL);
+    """
+
+    OPERATORS = ('=', '<', '>')
+
+    MAX_PARAMETERS = 500
+
+    #seconds
+    BUSY_TIMEOUT = 60
+
+    def __init__(self, directory, file_name):
+        super().__init__()
+        self._dir = directory
+        self._file = os.path.join(directory, file_name)
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            if not os.path.exists(self._dir):
+                os.makedirs(self._dir)
+            with metrics.phase('cache_load'):
+                import sqlite3
+                #other processes may be writing: wait for them rather than
+                #failing, and let readers see the last commit meanwhile
+                self._connection = sqlite3.connect(self._file, timeout=SqliteCache.BUSY_TIMEOUT)
+                self._connection.execute('PRAGMA journal_mode=WAL')
+                self._connection.executescript(SqliteCache.SCHEMA)
+        return self._connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        if self._batch_depth > 0:
+            #committed at the end of the batch
+            self._changed()
+            yield connection
+        else:
+            metrics.count('cache.flush')
+            with connection:
+                yield connection
+
+    def _flush(self):
+        metrics.count('cache.flush')
+        with metrics.phase('cache_write'):
+            self._connection.commit()
+
+    def _to_row(self, activity):
+        return tuple(activity.get(column) for column in SqliteCache.COLUMNS) + (json.dumps(activity),)
+
+    def _select_activities(self, where = '', params = ()):
+        cursor = self._connect().execute(
+            'SELECT data FROM activities {} ORDER BY start_date DESC'.format(where), params)
+        return [json.loads(data) for data, in cursor]
+
+    def is_initialized(self):
+        if not os.path.exists(self._file):
+            return False
+        row = self._connect().execute(
+            "SELECT value FROM metadata WHERE key = 'initialized'").fetchone()
+        return row is not None
+
+    def get_activities(self):
+        return self._select_activities()
+
+    def update_activities(self, activities):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM activities')
+            connection.executemany(
+                'INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [self._to_row(activity) for activity in activities])
+            connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES ('initialized', '1')")
+
+    def get_activity(self, id):
+        activities = self._select_activities('WHERE id = ?', (id,))
+        return activities[0] if activities else None
+
+    def count_activities(self):
+        if not os.path.exists(self._file):
+            return 0
+        return self._connect().execute('SELECT COUNT(*) FROM activities').fetchone()[0]
+
+    def get_activities_by_ids(self, ids):
+        ids = list(ids)
+        activities = []
+        #sqlite limits the number of parameters of a statement
+        for start in range(0, len(ids), SqliteCache.MAX_PARAMETERS):
+            chunk = ids[start:start + SqliteCache.MAX_PARAMETERS]
+            activities += self._select_activities(
+                'WHERE id IN ({})'.format(', '.join('?' * len(chunk))), chunk)
+        activities.sort(key=lambda activity: activity['start_date'], reverse=True)
+        return activities
+
+    def update_activity(self, activity):
+        a = self.get_activity(activity['id'])
+        if a is None:
+            return
+        for k, v in activity.items():
+            a[k] = v
+        with self._transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self._to_row(a))
+
+    def delete_activities(self, ids):
+        with self._transaction() as connection:
+            connection.executemany('DELETE FROM activities WHERE id = ?', [(id,) for id in ids])
+            connection.executemany('DELETE FROM activity_details WHERE id = ?', [(id,) for id in ids])
+
+    def get_metadata(self, key, default = None):
+        row = self._connect().execute(
+            'SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set_metadata(self, key, value):
+        with self._transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO metadata VALUES (?, ?)', (key, json.dumps(value)))
+
+    def get_all_metadata(self):
+        if not os.path.exists(self._file):
+            return {}
+        return {key: json.loads(value) for key, value in
+                self._connect().execute('SELECT key, value FROM metadata')}
+
+    def merge_activities(self, new_activities):
+        with self._transaction() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [self._to_row(activity) for activity in new_activities])
+
+    def find_activities(self, predicate):
+        #narrow down the rows using the indexed columns, then let the
+        #predicate check the remaining conditions
+        clauses = []
+        params = []
+        for name, operator, value in predicate.constraints():
+            if name in SqliteCache.COLUMNS and operator in SqliteCache.OPERATORS:
+                clauses.append('{} {} ?'.format(name, operator))
+                params.append(value)
+        where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return predicate.filter(self._select_activities(where, params))
+
+    def update_activity_detail(self, activity_detail):
+        with self._transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO activity_details VALUES (?, ?)',
+                (activity_detail['id'], json.dumps(activity_detail)))
+
+    def get_activity_detail(self, id):
+        row = self._connect().execute(
+            'SELECT data FROM activity_details WHERE id = ?', (int(id),)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_activity_details(self):
+        cursor = self._connect().execute('SELECT data FROM activity_details')
+        return [json.loads(data) for data, in cursor]
+
+    def clear_activity_details(self):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM activity_details')
+
     def clear(self):
-        cache_file = self._cache_file()
-        if os.path.exists(cache_file):
-            os.remove(cache_file)
-        self._cache = {}
+        if not os.path.exists(self._file):
+            return
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM activities')
+            connection.execute('DELETE FROM activity_details')
+            connection.execute('DELETE FROM metadata')
+
+
+class FileStore(util.Batched):
+    #one file per entry; when the files exceed max_size bytes or max_count
+    #entries, the least recently used ones are removed. Eviction scans the
+    #whole directory, so inside batch it runs once at the end. Several
+    #processes can use the same store: files are written to hidden temporary
+    #files and renamed, evictions are serialized by a lock and files removed
+    #by another process are ignored
+
+    LOCK_FILE = '.lock'
+
+    def __init__(self, directory, max_size = None, max_count = None):
+        super().__init__()
+        self._dir = directory
+        self._max_size = max_size
+        self._max_count = max_count
+
+    def _path(self, name):
+        return os.path.join(self._dir, name)
+
+    def is_initialized(self):
+        return os.path.exists(self._dir)
+
+    def initialize(self):
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir)
+
+    def _touch(self, path):
+        #the modification time tracks the last use
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _write(self, name, data):
+        self.initialize()
+        with tempfile.NamedTemporaryFile(dir=self._dir, prefix='.', mode='wb', delete=False) as outfile:
+            outfile.write(data)
+        os.replace(outfile.name, self._path(name))
+        self._changed()
+
+    def _flush(self):
+        self._evict()
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _remove(self, name):
+        self._unlink(self._path(name))
+
+    def _entries(self):
+        #hidden files (the lock and temporary files) are not entries
+        if not os.path.exists(self._dir):
+            return []
+        entries = []
+        for entry in os.scandir(self._dir):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _evict(self):
+        if self._max_size is None and self._max_count is None:
+            return
+        with util.file_lock(self._path(FileStore.LOCK_FILE)):
+            entries = self._entries()
+            size = sum(entry_size for _, entry_size, _ in entries)
+            count = len(entries)
+            for _, entry_size, path in sorted(entries):
+                if ((self._max_size is None or size <= self._max_size) and
+                        (self._max_count is None or count <= self._max_count)):
+                    break
+                self._unlink(path)
+                size -= entry_size
+                count -= 1
+
+    def clear(self):
+        for _, _, path in self._entries():
+            self._unlink(path)
+
+
+class StreamStore(FileStore):
+    #activity streams never change, so they are kept as encoded gps tracks in
+    #one file per activity and set of stream types
+
+    DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, directory, max_size = DEFAULT_MAX_SIZE):
+        super().__init__(directory, max_size=max_size)
+
+    def _name(self, id, stream_types):
+        return '{}-{}.gps'.format(id, '-'.join(sorted(stream_types)))
+
+    def contains(self, id, stream_types):
+        if os.path.exists(self._path(self._name(id, stream_types))):
+            return True
+        metrics.count('streams.miss')
+        return False
+
+    def get(self, id, stream_types):
+        #the track maps the file, keeping a file descriptor open until it is
+        #released. Only missing and invalid files are misses: other errors
+        #(e.g. too many open files) are raised
+        path = self._path(self._name(id, stream_types))
+        try:
+            track = tracks.GpsTrack.load(path)
+        except (FileNotFoundError, ValueError):
+            metrics.count('streams.miss')
+            return None
+        metrics.count('streams.hit')
+        self._touch(path)
+        return track
+
+    def put(self, id, stream_types, track):
+        self._write(self._name(id, stream_types), track.to_bytes())
+
+
+class DetailStore(FileStore):
+    #activity details, one json file per activity, read only when requested.
+    #Details older than ttl seconds are treated as missing, so they are
+    #downloaded again
+
+    DEFAULT_MAX_COUNT = 1000
+
+    def __init__(self, directory, max_count = DEFAULT_MAX_COUNT, ttl = None):
+        super().__init__(directory, max_count=max_count)
+        self._ttl = ttl
+
+    def _name(self, id):
+        return '{}.json'.format(id)
+
+    def get(self, id):
+        path = self._path(self._name(id))
+        try:
+            with open(path) as infile:
+                entry = json.load(infile)
+        except (OSError, ValueError):
+            metrics.count('details.miss')
+            return None
+        if self._ttl is not None and time.time() - entry['fetched_at'] > self._ttl:
+            metrics.count('details.expired')
+            return None
+        metrics.count('details.hit')
+        self._touch(path)
+        return entry['detail']
+
+    def put(self, activity_detail):
+        entry = {'fetched_at': time.time(), 'detail': activity_detail}
+        self._write(self._name(activity_detail['id']), json.dumps(entry).encode('utf-8'))
+
+    def delete(self, ids):
+        for id in ids:
+            self._remove(self._name(id))
+
+    def get_activity_details(self):
+        #every stored detail, regardless of ttl and without marking them used
+        activity_details = []
+        for _, _, path in self._entries():
+            try:
+                with open(path) as infile:
+                    activity_details.append(json.load(infile)['detail'])
+            except (OSError, ValueError, KeyError):
+                continue
+        return activity_details
+
+
+JSON_CACHE_FILE = 'activities.json'
+SQLITE_CACHE_FILE = 'activities.db'
+STREAMS_DIR = 'streams'
+DETAILS_DIR = 'details'
+TEXT_INDEX_FILE = 'text-index.json'
+SPATIAL_INDEX_FILE = 'spatial-index.json'
+AGGREGATES_FILE = 'aggregates.json'
+
+
+def _json_cache():
+    return JsonCache(config.get_strava_cli_dir(), JSON_CACHE_FILE)
+
+
+def _sqlite_cache():
+    return SqliteCache(config.get_strava_cli_dir(), SQLITE_CACHE_FILE)
+
+
+def migrate_to_sqlite():
+    json_cache = _json_cache()
+    sqlite_cache = _sqlite_cache()
+    if json_cache.is_initialized():
+        sqlite_cache.update_activities(json_cache.get_activities())
+        for activity_detail in json_cache.get_activity_details():
+            sqlite_cache.update_activity_detail(activity_detail)
+        #sync cursor, fingerprints...
+        for key, value in json_cache.get_all_metadata().items():
+            sqlite_cache.set_metadata(key, value)
+        json_cache.clear()
+    else:
+        #creates an empty database, which selects the sqlite backend
+        sqlite_cache._connect()
+    return sqlite_cache
+
+
+def get_stream_store():
+    return StreamStore(os.path.join(config.get_strava_cli_dir(), STREAMS_DIR))
+
+
+def get_detail_store(max_count = DetailStore.DEFAULT_MAX_COUNT, ttl = None):
+    return DetailStore(os.path.join(config.get_strava_cli_dir(), DETAILS_DIR), max_count, ttl)
+
+
+def get_text_index():
+    return indexes.TextIndex(config.get_strava_cli_dir(), TEXT_INDEX_FILE)
+
+
+def get_spatial_index():
+    return indexes.SpatialIndex(config.get_strava_cli_dir(), SPATIAL_INDEX_FILE)
+
+
+def get_aggregates():
+    return stats.Aggregates(config.get_strava_cli_dir(), AGGREGATES_FILE)
+
+
+def move_activity_details(cache, detail_store):
+    #details used to be kept with the activities: they are moved to the
+    #detail store, so loading the activities doesn't load them anymore. This
+    #is done once, when the detail store doesn't exist yet
+    if detail_store.is_initialized():
+        return
+    activity_details = cache.get_activity_details()
+    for activity_detail in activity_details:
+        detail_store.put(activity_detail)
+    if activity_details:
+        cache.clear_activity_details()
+    detail_store.initialize()
 
 
 def get_cache():
-    return JsonCache(config.get_strava_cli_dir(), 'activities.json')
+    if os.path.exists(os.path.join(config.get_strava_cli_dir(), SQLITE_CACHE_FILE)):
+        return _sqlite_cache()
+    return _json_cache()
@@ -0,0 +1,114 @@
+import config
+import json
+import logging
+import os
+import os.path
+import socket
+import struct
+
+
+SOCKET_FILE = 'daemon.sock'
+
+#frames sent by the daemon: command output (utf-8 text) or the exit code
+OUTPUT = b'O'
+EXIT = b'X'
+FRAME = struct.Struct('>cI')
+
+
+def get_socket_path():
+    return os.path.join(config.get_strava_cli_dir(), SOCKET_FILE)
+
+
+class FrameWriter(object):
+    #file-like object sending what is written to the client as output frames
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        if data:
+            self._connection.sendall(FRAME.pack(OUTPUT, len(data)) + data)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class Server(object):
+    #serves one command at a time over a unix domain socket; handler is
+    #called with the command line arguments and a file-like object for the
+    #output, and returns the exit code
+
+    def __init__(self, path, handler):
+        self._path = path
+        self._handler = handler
+
+    def _serve(self, connection):
+        out = FrameWriter(connection)
+        try:
+            line = connection.makefile('r', encoding='utf-8').readline()
+            if not line:
+                #the client closed the connection without sending a command
+                return
+            argv = json.loads(line)['argv']
+            logging.getLogger('Server').info("Running {}".format(argv))
+            code = self._handler(argv, out)
+        except Exception as e:
+            logging.getLogger('Server').exception(e)
+            out.write('Error: {}\n'.format(e))
+            code = 1
+        connection.sendall(FRAME.pack(EXIT, code))
+
+    def serve_forever(self):
+        directory = os.path.dirname(self._path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(self._path):
+            #left by a daemon that didn't shut down cleanly
+            os.remove(self._path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self._path)
+            os.chmod(self._path, 0o600)
+            server.listen()
+            while True:
+                connection, _ = server.accept()
+                #a failed request never stops the server
+                with connection:
+                    try:
+                        self._serve(connection)
+                    except OSError as e:
+                        #the client went away
+                        logging.getLogger('Server').warning(e)
+                    except Exception as e:
+                        logging.getLogger('Server').exception(e)
+        finally:
+            server.close()
+            os.remove(self._path)
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise ConnectionError("Connection to the daemon closed")
+    return data
+
+
+def run(path, argv, out):
+    #runs the command in the daemon, writing its output to out. Returns the
+    #exit code, or None if no daemon is running
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        return None
+    with connection:
+        connection.sendall((json.dumps({'argv': argv}) + '\n').encode('utf-8'))
+        stream = connection.makefile('rb')
+        while True:
+            kind, value = FRAME.unpack(_read_exactly(stream, FRAME.size))
+            if kind == EXIT:
+                return value
+            out.write(_read_exactly(stream, value).decode('utf-8'))
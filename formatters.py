@@ -1,6 +1,12 @@
 import json
-import gpxpy
 import datetime
+import sys
+import metrics
+
+
+def escape_xml(text):
+    #same as xml.sax.saxutils.escape, which would import urllib and http
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
 
 class Formatter(object):
@@ -53,31 +59,172 @@ class JsonFormatter(Formatter):
 
 
 class GpxFormatter(Formatter):
+    #writes the same document gpxpy renders with prettyprint, without
+    #building the object tree: points are formatted in chunks of CHUNK_SIZE
+
+    CHUNK_SIZE = 1000
+
+    HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+        '<gpx xmlns="http://www.topografix.com/GPX/1/1" ' \
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
+        'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" ' \
+        'version="1.1" creator="gpx.py -- https://github.com/tkrajina/gpxpy">\n' \
+        '  <trk>\n'
+
+    FOOTER = '    </trkseg>\n  </trk>\n</gpx>'
+
+    POINT = '      <trkpt lat="{}" lon="{}">\n{}        <time>{}{:02}:{:02}:{:02}Z</time>\n      </trkpt>\n'
+
+    def _track_header(self, activity):
+        output = GpxFormatter.HEADER
+        if activity.get('name') is not None:
+            output += '    <name>{}</name>\n'.format(escape_xml(activity['name']))
+        #extensions are better for this, but gpxpy doesn't support extensions
+        output += '    <cmt>{}</cmt>\n'.format(activity.get('id'))
+        if activity.get('type') is not None:
+            output += '    <type>{}</type>\n'.format(escape_xml(activity['type']))
+        return output + '    <trkseg>\n'
+
+    def chunks(self, activity, gps):
+        yield self._track_header(activity)
+        points = []
+        day = None
+        for time, point, altitude in gps:
+            #timestamps are utc: the date is formatted once per day
+            current_day, seconds = divmod(int(time), 86400)
+            if current_day != day:
+                day = current_day
+                date = datetime.datetime.fromtimestamp(day * 86400, datetime.timezone.utc).strftime('%Y-%m-%dT')
+            hours, seconds = divmod(seconds, 3600)
+            minutes, seconds = divmod(seconds, 60)
+            elevation = '        <ele>{}</ele>\n'.format(altitude) if altitude is not None else ''
+            points.append(GpxFormatter.POINT.format(
+                point[0], point[1], elevation, date, hours, minutes, seconds))
+            if len(points) == GpxFormatter.CHUNK_SIZE:
+                yield ''.join(points)
+                points = []
+        yield ''.join(points) + GpxFormatter.FOOTER
 
     def format(self, activity, gps):
-        gpx = gpxpy.gpx.GPX()
+        return ''.join(self.chunks(activity, gps))
 
-        gpx_track = gpxpy.gpx.GPXTrack(
-            name=activity.get('name'))
-        gpx_track.type = activity.get('type')
-        gpx_track.comment = str(activity.get('id')) #extensions are better for this, but gpxpy doesn't support extensions
-        gpx.tracks.append(gpx_track)
+    ROUTE_POINT = '      <trkpt lat="{}" lon="{}"></trkpt>\n'
 
-        gpx_segment = gpxpy.gpx.GPXTrackSegment()
-        gpx_track.segments.append(gpx_segment)
+    def route_chunks(self, activity, points):
+        #routes decoded from polylines: (latitude, longitude) points, without
+        #times and elevations
+        yield self._track_header(activity)
+        for start in range(0, len(points), GpxFormatter.CHUNK_SIZE):
+            yield ''.join(GpxFormatter.ROUTE_POINT.format(latitude, longitude)
+                          for latitude, longitude in points[start:start + GpxFormatter.CHUNK_SIZE])
+        yield GpxFormatter.FOOTER
 
 
-        for time, point, altitude in gps:
-            time = datetime.datetime.fromtimestamp(time).astimezone()
-            gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(latitude=point[0], longitude=point[1], elevation=altitude, time=time))
-            
-        return gpx.to_xml(prettyprint=True)
+class JsonGpsFormatter(Formatter):
+    #same output of json.dumps({'activity': activity, 'data': list(gps)}),
+    #points are encoded in chunks
+
+    CHUNK_SIZE = 1000
+
+    def chunks(self, activity, gps):
+        yield '{{"activity": {}, "data": ['.format(json.dumps(activity))
+        points = []
+        separator = ''
+        for point in gps:
+            points.append(json.dumps(point))
+            if len(points) == JsonGpsFormatter.CHUNK_SIZE:
+                yield separator + ', '.join(points)
+                separator = ', '
+                points = []
+        if points:
+            yield separator + ', '.join(points)
+        yield ']}'
+
+    def format(self, activity, gps):
+        return ''.join(self.chunks(activity, gps))
 
 
-class JsonGpsFormatter(Formatter):
+class NdjsonGpsFormatter(Formatter):
+    #the activity on the first line, then one point per line
+
+    CHUNK_SIZE = 1000
+
+    def chunks(self, activity, gps):
+        yield json.dumps(activity)
+        points = []
+        for point in gps:
+            points.append(json.dumps(point))
+            if len(points) == NdjsonGpsFormatter.CHUNK_SIZE:
+                yield '\n' + '\n'.join(points)
+                points = []
+        if points:
+            yield '\n' + '\n'.join(points)
 
     def format(self, activity, gps):
-        return json.dumps({'activity':activity, 'data':list(gps)})
+        return ''.join(self.chunks(activity, gps))
+
+
+class GeoJsonFormatter(Formatter):
+    #a FeatureCollection of LineStrings, one feature at a time
+
+    PROPERTIES = ('id', 'name', 'type', 'start_date', 'start_date_local', 'distance',
+                  'moving_time', 'total_elevation_gain')
+
+    def feature(self, activity, points):
+        return json.dumps({
+            'type': 'Feature',
+            'id': activity['id'],
+            'properties': {key: activity.get(key) for key in GeoJsonFormatter.PROPERTIES},
+            #geojson positions are longitude, latitude
+            'geometry': {'type': 'LineString',
+                         'coordinates': [[longitude, latitude] for latitude, longitude in points]},
+        })
+
+    def chunks(self, routes):
+        #routes are (activity, points) pairs
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = '\n'
+        for activity, points in routes:
+            yield separator + self.feature(activity, points)
+            separator = ',\n'
+        yield '\n]}'
+
+
+class BufferedWriter(object):
+    #collects the output and writes it to the stream in blocks of about
+    #buffer_size characters, instead of one write per line
+
+    DEFAULT_BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, stream = None, buffer_size = DEFAULT_BUFFER_SIZE):
+        self._stream = stream if stream is not None else sys.stdout
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._size = 0
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def writeline(self, text):
+        self.write(text)
+        self.write('\n')
+
+    def flush(self):
+        with metrics.phase('write'):
+            if self._buffer:
+                self._stream.write(''.join(self._buffer))
+                self._buffer = []
+                self._size = 0
+            self._stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
 
 
 def get_formatter(json_output = False, quiet = False, verbose = False, utc = False):
@@ -86,6 +233,8 @@ def get_formatter(json_output = False, quiet = False, verbose = False, utc = Fal
 def get_formatter_details(json_output = False, quiet = False, verbose = False, utc = False):
     return JsonFormatter(quiet, verbose, utc) if json_output else DetailFormatter(quiet, verbose, utc)
 
-def get_formatter_gps(json_output = False):
+def get_formatter_gps(json_output = False, ndjson_output = False):
+    if ndjson_output:
+        return NdjsonGpsFormatter()
     return JsonGpsFormatter() if json_output else GpxFormatter()
 
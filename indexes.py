@@ -0,0 +1,240 @@
+import math
+import os
+import os.path
+import re
+import util
+
+
+TOKEN = re.compile(r'\w+')
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def tokenize(text):
+    return set(TOKEN.findall(text.lower())) if text else set()
+
+
+def distance(latitude1, longitude1, latitude2, longitude2):
+    #great circle distance in km (haversine)
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(longitude2 - longitude1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+
+
+class JsonIndex(util.JsonDocument):
+    #index of the activities kept in memory and stored as a json file next
+    #to the cache, shared by concurrent commands like the cache itself (see
+    #util.JsonDocument); changes made inside batch are written once at the end
+
+    def __init__(self, directory, filename):
+        super().__init__(os.path.join(directory, filename))
+
+    def is_initialized(self):
+        return self._document is not None or os.path.exists(self._path)
+
+    def update(self, activities):
+        self._change('_update', activities)
+
+    def _update(self, activities):
+        raise NotImplementedError
+
+    def remove(self, ids):
+        self._change('_remove', ids)
+
+    def _remove(self, ids):
+        raise NotImplementedError
+
+    def rebuild(self, activities):
+        self._change('_rebuild', activities)
+
+    def _rebuild(self, activities):
+        self._document = self._empty()
+        self._reset()
+        self._update(activities)
+
+    def clear(self):
+        self._delete_file()
+
+
+class TextIndex(JsonIndex):
+    #inverted index of the activity names and descriptions (token -> ids).
+    #Descriptions are only known for the activities whose details have been
+    #downloaded
+
+    FIELDS = ('name', 'description')
+
+    def __init__(self, directory, filename):
+        super().__init__(directory, filename)
+        #field -> id -> tokens, built when the first change is made
+        self._tokens = None
+
+    def _empty(self):
+        return {field: {} for field in TextIndex.FIELDS}
+
+    def _from_json(self, data):
+        postings = self._empty()
+        for field, tokens in data.items():
+            postings[field] = {token: set(ids) for token, ids in tokens.items()}
+        return postings
+
+    def _to_json(self):
+        return {field: {token: sorted(ids) for token, ids in tokens.items()}
+                for field, tokens in self._get_document().items()}
+
+    def _reset(self):
+        self._tokens = None
+
+    def _get_tokens(self):
+        if self._tokens is None:
+            self._tokens = {field: {} for field in TextIndex.FIELDS}
+            for field, tokens in self._get_document().items():
+                for token, ids in tokens.items():
+                    for id in ids:
+                        self._tokens[field].setdefault(id, set()).add(token)
+        return self._tokens
+
+    def _set(self, field, id, text):
+        postings = self._get_document()[field]
+        tokens = self._get_tokens()[field]
+        old_tokens = tokens.pop(id, set())
+        new_tokens = tokenize(text)
+        for token in old_tokens - new_tokens:
+            ids = postings[token]
+            ids.discard(id)
+            if not ids:
+                del postings[token]
+        for token in new_tokens - old_tokens:
+            postings.setdefault(token, set()).add(id)
+        if new_tokens:
+            tokens[id] = new_tokens
+
+    def _update(self, activities):
+        #activities or details: descriptions are indexed only if present
+        for activity in activities:
+            for field in TextIndex.FIELDS:
+                if field in activity:
+                    self._set(field, activity['id'], activity[field])
+
+    def _remove(self, ids):
+        for id in ids:
+            for field in TextIndex.FIELDS:
+                self._set(field, id, None)
+
+    def search(self, fields, terms):
+        #ids of the activities containing every term in at least one field;
+        #the rarest terms are intersected first
+        postings = self._get_document()
+        term_ids = sorted((set().union(*(postings[field].get(term, ()) for field in fields))
+                           for term in terms), key=len)
+        if not term_ids:
+            return set()
+        result = set(term_ids[0])
+        for ids in term_ids[1:]:
+            result &= ids
+        return result
+
+
+class SpatialIndex(JsonIndex):
+    #grid of CELL_SIZE degrees cells on the start location of the activities
+    #(cell -> id -> (latitude, longitude)), so that a query only looks at the
+    #activities in the cells it overlaps
+
+    CELL_SIZE = 0.1
+
+    def __init__(self, directory, filename):
+        super().__init__(directory, filename)
+        #id -> cell, built when the first change is made
+        self._cells = None
+
+    def _cell(self, latitude, longitude):
+        return (math.floor(latitude / SpatialIndex.CELL_SIZE), math.floor(longitude / SpatialIndex.CELL_SIZE))
+
+    def _empty(self):
+        return {}
+
+    def _from_json(self, data):
+        grid = {}
+        for key, points in data.items():
+            row, column = key.split(',')
+            grid[(int(row), int(column))] = {id: (latitude, longitude) for id, latitude, longitude in points}
+        return grid
+
+    def _to_json(self):
+        return {'{},{}'.format(*cell): [[id, latitude, longitude] for id, (latitude, longitude) in points.items()]
+                for cell, points in self._get_document().items()}
+
+    def _reset(self):
+        self._cells = None
+
+    def _get_cells(self):
+        if self._cells is None:
+            self._cells = {id: cell for cell, points in self._get_document().items() for id in points}
+        return self._cells
+
+    def _set(self, id, latlng):
+        grid = self._get_document()
+        cells = self._get_cells()
+        cell = cells.pop(id, None)
+        if cell is not None:
+            del grid[cell][id]
+            if not grid[cell]:
+                del grid[cell]
+        if latlng:
+            latitude, longitude = latlng
+            cell = self._cell(latitude, longitude)
+            grid.setdefault(cell, {})[id] = (latitude, longitude)
+            cells[id] = cell
+
+    def _update(self, activities):
+        #activities without start_latlng (e.g. indoor) are removed
+        for activity in activities:
+            if 'start_latlng' in activity:
+                self._set(activity['id'], activity['start_latlng'])
+
+    def _remove(self, ids):
+        for id in ids:
+            self._set(id, None)
+
+    def _longitude_ranges(self, west, east):
+        #splits the ranges crossing the antimeridian
+        if east - west >= 360:
+            return [(-180, 180)]
+        if west < -180:
+            return [(west + 360, 180), (-180, east)]
+        if east > 180:
+            return [(west, 180), (-180, east - 360)]
+        return [(west, east)]
+
+    def _points(self, south, west, north, east):
+        #(id, latitude, longitude) of the activities in the cells overlapping
+        #the box, which may contain some activities outside of it
+        grid = self._get_document()
+        rows = range(self._cell(south, 0)[0], self._cell(north, 0)[0] + 1)
+        for range_west, range_east in self._longitude_ranges(west, east):
+            columns = range(self._cell(0, range_west)[1], self._cell(0, range_east)[1] + 1)
+            if len(rows) * len(columns) > len(grid):
+                #large boxes: fewer cells are used than the box contains
+                cells = [cell for cell in grid if cell[0] in rows and cell[1] in columns]
+            else:
+                cells = [(row, column) for row in rows for column in columns if (row, column) in grid]
+            for cell in cells:
+                for id, (latitude, longitude) in grid[cell].items():
+                    yield id, latitude, longitude
+
+    def within(self, south, west, north, east):
+        ranges = self._longitude_ranges(west, east)
+        return {id for id, latitude, longitude in self._points(south, west, north, east)
+                if south <= latitude <= north and any(w <= longitude <= e for w, e in ranges)}
+
+    def near(self, latitude, longitude, radius):
+        #radius in km
+        dlatitude = radius / KM_PER_DEGREE
+        south, north = max(-90, latitude - dlatitude), min(90, latitude + dlatitude)
+        cos = math.cos(math.radians(max(abs(south), abs(north))))
+        dlongitude = radius / (KM_PER_DEGREE * cos) if cos > 0 else 360
+        return {id for id, point_latitude, point_longitude in self._points(
+                    south, longitude - min(dlongitude, 180), north, longitude + min(dlongitude, 180))
+                if distance(latitude, longitude, point_latitude, point_longitude) <= radius}
@@ -0,0 +1,109 @@
+import contextlib
+import json
+import re
+import sys
+import threading
+import time
+
+
+class Metrics(object):
+    #wall time per phase (exclusive of the nested phases), api calls per
+    #endpoint and counters of one command
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._stack = []
+        self._api = {}
+        self._counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        self._stack.append(0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._stack.pop()
+            self._phases[name] = self._phases.get(name, 0) + elapsed - nested
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def count(self, name, value):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def api_call(self, method, url, size, seconds):
+        #ids are removed from the url, so calls are grouped by endpoint
+        endpoint = '{} {}'.format(method, re.sub(r'/\d+', '/{id}', url.split('?')[0]))
+        with self._lock:
+            call = self._api.setdefault(endpoint, {'calls': 0, 'bytes': 0, 'seconds': 0})
+            call['calls'] += 1
+            call['bytes'] += size
+            call['seconds'] += seconds
+
+    def report(self):
+        return {
+            'total': time.perf_counter() - self._start,
+            'phases': dict(self._phases),
+            'api': {endpoint: dict(call) for endpoint, call in self._api.items()},
+            'counters': dict(self._counters),
+        }
+
+    def write(self, path):
+        #'-' prints a summary to stderr, any other path is a json file
+        report = self.report()
+        if path != '-':
+            with open(path, 'w') as outfile:
+                json.dump(report, outfile, indent=2)
+            return
+        out = sys.stderr
+        print('total {:.3f} s'.format(report['total']), file=out)
+        for name, seconds in sorted(report['phases'].items(), key=lambda phase: -phase[1]):
+            print('  {:<30} {:10.3f} s'.format(name, seconds), file=out)
+        if report['api']:
+            print('api calls', file=out)
+            for endpoint, call in sorted(report['api'].items()):
+                print('  {:<30} {:6} calls {:10} bytes {:10.3f} s'.format(
+                    endpoint, call['calls'], call['bytes'], call['seconds']), file=out)
+        if report['counters']:
+            print('counters', file=out)
+            for name, value in sorted(report['counters'].items()):
+                print('  {:<30} {:10}'.format(name, round(value, 3)), file=out)
+
+
+#set by enable; while it's None the functions below do nothing
+_metrics = None
+_no_phase = contextlib.nullcontext()
+
+
+def enable():
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def enabled():
+    return _metrics is not None
+
+
+def get():
+    return _metrics
+
+
+def phase(name):
+    if _metrics is None:
+        return _no_phase
+    return _metrics.phase(name)
+
+
+def count(name, value = 1):
+    if _metrics is not None:
+        _metrics.count(name, value)
+
+
+def api_call(method, url, size, seconds):
+    if _metrics is not None:
+        _metrics.api_call(method, url, size, seconds)
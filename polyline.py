@@ -0,0 +1,57 @@
+import itertools
+
+
+#encoded polyline algorithm format, as used by map.summary_polyline:
+#https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+PRECISION = 5
+
+
+def _decode_values(data):
+    #zig-zag encoded varints, 5 bits per character offset by 63
+    values = []
+    append = values.append
+    result = 0
+    shift = 0
+    for byte in data:
+        byte -= 63
+        result |= (byte & 0x1f) << shift
+        if byte & 0x20:
+            shift += 5
+            continue
+        append(~(result >> 1) if result & 1 else result >> 1)
+        result = 0
+        shift = 0
+    return values
+
+
+def decode(encoded, precision = PRECISION):
+    #returns the list of (latitude, longitude) points; the deltas are summed
+    #and scaled column by column rather than point by point
+    values = _decode_values(encoded.encode('ascii'))
+    scale = 10 ** precision
+    latitudes = itertools.accumulate(values[0::2])
+    longitudes = itertools.accumulate(values[1::2])
+    return [(latitude / scale, longitude / scale) for latitude, longitude in zip(latitudes, longitudes)]
+
+
+def _encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chars = []
+    while value >= 0x20:
+        chars.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+def encode(points, precision = PRECISION):
+    scale = 10 ** precision
+    output = []
+    previous_latitude = previous_longitude = 0
+    for latitude, longitude in points:
+        latitude, longitude = round(latitude * scale), round(longitude * scale)
+        output.append(_encode_value(latitude - previous_latitude))
+        output.append(_encode_value(longitude - previous_longitude))
+        previous_latitude, previous_longitude = latitude, longitude
+    return ''.join(output)
@@ -1,45 +1,91 @@
 import time
 import datetime
-import util
 import logging
+import indexes
 
 
 class Predicate(object):
 
+    #relative cost of matches, cheaper predicates are evaluated first
+    cost = 0
+
+    #whether constraints describe the predicate completely
+    exact = False
+
     def matches(self, value):
         raise NotImplementedError
 
+    def constraints(self):
+        #(field, operator, value) tuples that caches can use to narrow down
+        #candidates before calling matches
+        return []
+
+    def filter(self, activities):
+        return [activity for activity in activities if self.matches(activity)]
+
+    def predicates(self):
+        return [self]
+
 
 class AlwaysTruePredicate(Predicate):
 
+    exact = True
+
     def matches(self, value):
         return True
 
+    def filter(self, activities):
+        return list(activities)
+
 
 class DatePredicate(Predicate):
 
+    cost = 2
+    exact = True
+
+    #dates are compared as strings: activity dates share this format, which
+    #sorts as the dates themselves, so they don't need to be parsed
+    DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
     def __init__(self, date, utc = False):
         self._date = date
         self._utc = utc
-
-    def _parse_date(self, value):
-        return util.parse_date(value['start_date' if self._utc else 'start_date_local'])
+        self._field = 'start_date' if utc else 'start_date_local'
+        self._date_str = date.strftime(DatePredicate.DATE_FORMAT)
 
 
 class AfterPredicate(DatePredicate):
 
+    #local dates are at most this far ahead of utc ones
+    MAX_UTC_OFFSET = datetime.timedelta(hours=14)
+
     def matches(self, value):
-        return self._parse_date(value) > self._date
+        return value[self._field] > self._date_str
+
+    def constraints(self):
+        return [(self._field, '>', self._date_str)]
+
+    def utc_lower_bound(self):
+        #activities whose utc start date is not after this one can't match
+        if self._utc:
+            return self._date_str
+        return (self._date - AfterPredicate.MAX_UTC_OFFSET).strftime(DatePredicate.DATE_FORMAT)
 
 
 class BeforePredicate(DatePredicate):
 
     def matches(self, value):
-        return self._parse_date(value) < self._date
+        return value[self._field] < self._date_str
+
+    def constraints(self):
+        return [(self._field, '<', self._date_str)]
 
 
 class EqPredicate(Predicate):
 
+    cost = 1
+    exact = True
+
     def __init__(self, name, value):
         self._name = name
         self._value = value
@@ -47,9 +93,15 @@ class EqPredicate(Predicate):
     def matches(self, value):
         return value[self._name] == self._value
 
+    def constraints(self):
+        return [(self._name, '=', self._value)]
+
 
 class RangePredicate(Predicate):
 
+    cost = 1
+    exact = True
+
     def __init__(self, name, min_value, max_value):
         self._name = name
         self._min = min_value
@@ -63,6 +115,107 @@ class RangePredicate(Predicate):
             return num > self._min
         return num > self._min and num < self._max
 
+    def constraints(self):
+        constraints = []
+        if self._min is not None:
+            constraints.append((self._name, '>', self._min))
+        if self._max is not None:
+            constraints.append((self._name, '<', self._max))
+        return constraints
+
+
+class IndexedPredicate(Predicate):
+    #predicates that an index (see indexes.py) can resolve to the ids of the
+    #matching activities; until they are resolved, the activity is checked
+
+    #name of the index able to resolve the predicate
+    index = None
+
+    def __init__(self):
+        self._ids = None
+
+    def search(self, index):
+        raise NotImplementedError
+
+    def resolve(self, ids):
+        self._ids = ids
+
+    def matches(self, value):
+        if self._ids is not None:
+            return value['id'] in self._ids
+        return self.matches_activity(value)
+
+    def matches_activity(self, value):
+        raise NotImplementedError
+
+
+class TextPredicate(IndexedPredicate):
+    #activities whose fields contain every word of the text
+
+    cost = 3
+    index = 'text'
+
+    def __init__(self, fields, text):
+        super().__init__()
+        self.fields = fields
+        self.terms = indexes.tokenize(text)
+        if not self.terms:
+            raise ValueError("Invalid text {}".format(text))
+
+    def search(self, index):
+        return index.search(self.fields, self.terms)
+
+    def matches_activity(self, value):
+        tokens = set()
+        for field in self.fields:
+            tokens |= indexes.tokenize(value.get(field))
+        return self.terms <= tokens
+
+
+class NearPredicate(IndexedPredicate):
+    #activities starting at most radius km from the point
+
+    cost = 2
+    index = 'spatial'
+
+    def __init__(self, latitude, longitude, radius):
+        super().__init__()
+        self._latitude = latitude
+        self._longitude = longitude
+        self._radius = radius
+
+    def search(self, index):
+        return index.near(self._latitude, self._longitude, self._radius)
+
+    def matches_activity(self, value):
+        latlng = value.get('start_latlng')
+        return bool(latlng) and indexes.distance(
+            self._latitude, self._longitude, latlng[0], latlng[1]) <= self._radius
+
+
+class BoundingBoxPredicate(IndexedPredicate):
+    #activities starting inside the box; west is greater than east for boxes
+    #crossing the antimeridian
+
+    cost = 2
+    index = 'spatial'
+
+    def __init__(self, south, west, north, east):
+        super().__init__()
+        self._south = south
+        self._west = west
+        self._north = north
+        #east of 180 for boxes crossing the antimeridian, as the index expects
+        self._east = east + 360 if east < west else east
+
+    def search(self, index):
+        return index.within(self._south, self._west, self._north, self._east)
+
+    def matches_activity(self, value):
+        latlng = value.get('start_latlng')
+        return (bool(latlng) and self._south <= latlng[0] <= self._north and
+                (self._west <= latlng[1] <= self._east or self._west <= latlng[1] + 360 <= self._east))
+
 
 class AndPredicate(Predicate):
 
@@ -75,12 +228,50 @@ class AndPredicate(Predicate):
                 return False
         return True
 
+    @property
+    def exact(self):
+        return all(predicate.exact for predicate in self._predicates)
+
+    def predicates(self):
+        return [p for predicate in self._predicates for p in predicate.predicates()]
+
+    def constraints(self):
+        return [c for predicate in self._predicates for c in predicate.constraints()]
+
+
+class CompiledPredicate(AndPredicate):
+    #an AndPredicate optimized for activity lists sorted by start_date,
+    #newest first, as returned by the caches
+
+    def __init__(self, predicates):
+        super().__init__(sorted(predicates, key=lambda predicate: predicate.cost))
+        self._matchers = tuple(predicate.matches for predicate in self._predicates)
+        bounds = [predicate.utc_lower_bound() for predicate in self._predicates
+                  if isinstance(predicate, AfterPredicate)]
+        self._stop_date = max(bounds) if bounds else None
+
+    def matches(self, value):
+        for matches in self._matchers:
+            if not matches(value):
+                return False
+        return True
+
+    def filter(self, activities):
+        result = []
+        for activity in activities:
+            if self._stop_date is not None and activity['start_date'] <= self._stop_date:
+                #older activities can't match the after filter either
+                break
+            if self.matches(activity):
+                result.append(activity)
+        return result
+
 
 def parse_date(utc, date_str):
+    #activity dates (local ones too) are parsed as utc, so the filter date
+    #must be utc as well in order to be comparable
     parsed_date = datetime.datetime.strptime(date_str, "%Y%m%d")
-    if utc:
-        parsed_date.replace(tzinfo=datetime.timezone.utc)
-    return parsed_date
+    return parsed_date.replace(tzinfo=datetime.timezone.utc)
 
 
 def parse_bool(bool_str):
@@ -102,6 +293,13 @@ def parse_range(range_str):
     return (float(tokens[0]), float(tokens[1]))
 
 
+def parse_coordinates(coordinates_str, count):
+    tokens = coordinates_str.split(',')
+    if len(tokens) != count:
+        raise ValueError("Invalid coordinates {}".format(coordinates_str))
+    return [float(token) for token in tokens]
+
+
 def get_predicate(utc, name, value):
     if name == "before":
         return BeforePredicate(parse_date(utc, value), utc)
@@ -119,6 +317,19 @@ def get_predicate(utc, name, value):
     if name == "elevation":
         min_value, max_value = parse_range(value)
         return RangePredicate('total_elevation_gain', min_value, max_value)
+    #name~=value and text~=value, split on the first =
+    if name == "name~":
+        return TextPredicate(('name',), value)
+    if name == "text~":
+        return TextPredicate(('name', 'description'), value)
+    if name == "near":
+        latitude, longitude, radius = parse_coordinates(value, 3)
+        return NearPredicate(latitude, longitude, radius)
+    if name == "bbox":
+        south, west, north, east = parse_coordinates(value, 4)
+        if south > north:
+            raise ValueError("Invalid box {}: the first corner must be the south-west one".format(value))
+        return BoundingBoxPredicate(south, west, north, east)
     raise ValueError("Invalid type {}".format(name))
 
 
@@ -133,4 +344,4 @@ def get_predicate_from_filters(utc, items):
         except ValueError as e:
             logging.getLogger("get_predicate_from_filters").exception(e)
             raise ValueError("Invalid value {}".format(item))
-    return AndPredicate(predicates)
+    return CompiledPredicate(predicates)
@@ -2,7 +2,16 @@ import api
 import json
 from util import parse_date
 import cache
+import metrics
+import polyline
+import predicates
+from tracks import GpsTrack
+import datetime
+import hashlib
 import logging
+import collections
+import contextlib
+import time
 
 
 #unused
@@ -42,97 +51,365 @@ class CachedRepository:
 
     page_size = 100
 
-    def __init__(self, token, cache, update_cache = True, sleep = None):
-        self._client = api.Client(token, sleep)
+    UPDATED = 'updated'
+    UNCHANGED = 'unchanged'
+    FAILED = 'failed'
+
+    STREAM_TYPES = ('time', 'latlng', 'altitude')
+
+    #reconciliation, in seconds: every RECONCILE_INTERVAL the activities of
+    #the last RECONCILE_WINDOW and a RECONCILE_SLICE of older history
+    #(walking backwards, one slice per run) are compared with strava
+    RECONCILE_INTERVAL = 60 * 60
+    RECONCILE_WINDOW = 30 * 24 * 60 * 60
+    RECONCILE_SLICE = 180 * 24 * 60 * 60
+
+    def __init__(self, token, cache, update_cache = True, sleep = None,
+                 pool_size = api.DEFAULT_POOL_SIZE, jobs = 1, stream_store = None,
+                 sync_interval = None, detail_store = None, text_index = None,
+                 spatial_index = None, aggregates = None):
+        self._client = api.Client(token, sleep, pool_size)
         self._cache = cache
+        self._stream_store = stream_store
+        self._detail_store = detail_store
+        self._indexes = {name: index for name, index in (('text', text_index), ('spatial', spatial_index))
+                         if index is not None}
+        self._aggregates = aggregates
+        self._details_moved = False
         self._run_update_cache = update_cache
+        self._jobs = jobs
+        self._executor = None
+        #seconds between checks for new activities; None checks only once
+        self._sync_interval = sync_interval
+        self._cache_updated_at = None
 
-    def get_all_activities(self):
-        all_activities = []
-        page = 1
-        num = CachedRepository.page_size
-        while num == CachedRepository.page_size:
-            activities = self._client.get_activities_page(
-                page, CachedRepository.page_size)
+    def _get_executor(self):
+        #worker pool shared by every concurrent operation of the repository
+        if self._executor is None:
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(self._jobs)
+        return self._executor
+
+    def _map(self, fn, items):
+        #results are returned in order, each one as soon as it and the ones
+        #before it are ready
+        if self._jobs <= 1:
+            return map(fn, items)
+        return self._get_executor().map(fn, items)
+
+    def _load_page(self, get_page, page):
+        logging.getLogger('CachedRepository').info(
+                "Loading page {} of {} elements".format(page, CachedRepository.page_size))
+        activities = get_page(page, CachedRepository.page_size)
+        logging.getLogger('CachedRepository').debug(
+                "{} activities loaded".format(len(activities)))
+        return activities
+
+    def _get_pages(self, get_page):
+        #loads pages until a short one is found. The first page is loaded
+        #alone, since it's usually the only one; then, with more than one
+        #job, the following pages are requested ahead and collected in order
+        all_activities = self._load_page(get_page, 1)
+        if len(all_activities) < CachedRepository.page_size:
+            return all_activities
+        if self._jobs <= 1:
+            page = 2
+            while True:
+                activities = self._load_page(get_page, page)
+                all_activities.extend(activities)
+                if len(activities) < CachedRepository.page_size:
+                    return all_activities
+                page += 1
+        executor = self._get_executor()
+        next_page = 2
+        futures = collections.deque()
+        while True:
+            while len(futures) < self._jobs:
+                futures.append(executor.submit(self._load_page, get_page, next_page))
+                next_page += 1
+            activities = futures.popleft().result()
             all_activities.extend(activities)
-            num = len(activities)
-            page += 1
-        return all_activities
+            if len(activities) < CachedRepository.page_size:
+                for future in futures:
+                    future.cancel()
+                return all_activities
+
+    def get_all_activities(self):
+        return self._get_pages(self._client.get_activities_page)
 
     def _get_latest_timestamp(self, activities):
         if not activities:
             return 0
-        max_date = max([parse_date(a['start_date']) for a in activities])
-        return int(max_date.timestamp())
+        #dates in this format sort as the dates themselves
+        max_date = max(a['start_date'] for a in activities)
+        return int(parse_date(max_date).timestamp())
+
+    def _get_oldest_timestamp(self, activities):
+        if not activities:
+            return 0
+        return int(parse_date(min(a['start_date'] for a in activities)).timestamp())
+
+    def _fingerprint(self, activity):
+        return hashlib.sha1(json.dumps(activity, sort_keys=True).encode('utf-8')).hexdigest()[:16]
 
     def _init_cache(self):
         logging.getLogger('CachedRepository').debug("Initializing cache")
         activities = self.get_all_activities()
-        self._cache.update_activities(activities)
-
-    def _merge_lists(self, activities, new_activities):
-        #combine the two lists and make sure the new list is sorted by utc date
-        activity_ids = {activity['id']: index for index, activity in enumerate(activities)}
-        import sys
-        for new_activity in new_activities:
-            id = new_activity['id']
-            if id in activity_ids:
-                activities[activity_ids[id]] = new_activity
-            else:
-                activities.append(new_activity)
-        return sorted(activities, key=lambda activity: activity['start_date'], reverse=True)
-    
-    def _update_cache(self):
-        if not self._cache.is_initialized():
-            self._init_cache()
+        with self._cache.batch():
+            self._cache.update_activities(
+                sorted(activities, key=lambda activity: activity['start_date'], reverse=True))
+            self._cache.set_metadata('fingerprints', {
+                str(activity['id']): self._fingerprint(activity) for activity in activities})
+            self._cache.set_metadata('sync_cursor', self._get_latest_timestamp(activities))
+            self._cache.set_metadata('oldest_activity', self._get_oldest_timestamp(activities))
+            self._cache.set_metadata('reconciled_at', time.time())
+        for index in self._indexes.values():
+            index.rebuild(activities)
+        if self._aggregates is not None:
+            self._aggregates.rebuild(activities)
+
+    def _aggregates_initialized(self):
+        return self._aggregates is not None and self._aggregates.is_initialized()
+
+    def _store_activities(self, activities, deleted_ids = ()):
+        #applies downloaded and deleted activities, keeping the sync cursor
+        #and the fingerprints up to date
+        fingerprints = self._cache.get_metadata('fingerprints', {})
+        for activity in activities:
+            fingerprints[str(activity['id'])] = self._fingerprint(activity)
+        for id in deleted_ids:
+            fingerprints.pop(str(id), None)
+        changed_ids = [activity['id'] for activity in activities]
+        if self._aggregates_initialized():
+            #the cached versions are subtracted before they change
+            self._aggregates.add(self._cache.get_activities_by_ids(changed_ids + list(deleted_ids)), -1)
+        if activities:
+            self._cache.merge_activities(activities)
+            self._cache.set_metadata('sync_cursor', max(
+                self._cache.get_metadata('sync_cursor', 0), self._get_latest_timestamp(activities)))
+        if deleted_ids:
+            self._cache.delete_activities(deleted_ids)
+        if self._aggregates_initialized():
+            self._aggregates.add(self._cache.get_activities_by_ids(changed_ids))
+        if self._detail_store is not None:
+            #details of changed activities are downloaded again
+            self._detail_store.delete([activity['id'] for activity in activities] + list(deleted_ids))
+        self._update_indexes(activities, deleted_ids)
+        if activities or deleted_ids:
+            self._cache.set_metadata('fingerprints', fingerprints)
+
+    def _get_remote_range(self, after, before = None):
+        #the remote range is one second wider, so only activities which
+        #are certainly missing are deleted
+        return self._get_pages(
+            lambda page, per_page: self._client.get_activities_between(
+                after - 1, before + 1 if before is not None else None, page, per_page))
+
+    def _reconcile_range(self, after, before, remote_activities):
+        remote_ids = {activity['id'] for activity in remote_activities}
+        date_predicates = [predicates.AfterPredicate(
+            datetime.datetime.fromtimestamp(after, datetime.timezone.utc), True)]
+        if before is not None:
+            date_predicates.append(predicates.BeforePredicate(
+                datetime.datetime.fromtimestamp(before, datetime.timezone.utc), True))
+        local_activities = self._cache.find_activities(predicates.CompiledPredicate(date_predicates))
+        fingerprints = self._cache.get_metadata('fingerprints', {})
+        changed = [activity for activity in remote_activities
+                   if fingerprints.get(str(activity['id'])) != self._fingerprint(activity)]
+        deleted_ids = [activity['id'] for activity in local_activities if activity['id'] not in remote_ids]
+        logging.getLogger('CachedRepository').info(
+            "Reconciled {} - {}: {} changed, {} deleted".format(after, before, len(changed), len(deleted_ids)))
+        self._store_activities(changed, deleted_ids)
+
+    def _reconcile_ranges(self, now):
+        #(after, before) ranges to check: the recent activities and a slice
+        #of the history, moving back at every reconciliation
+        if now - self._cache.get_metadata('reconciled_at', 0) < CachedRepository.RECONCILE_INTERVAL:
+            return []
+        recent = int(now) - CachedRepository.RECONCILE_WINDOW
+        before = self._cache.get_metadata('reconcile_before') or recent
+        return [(recent, None), (before - CachedRepository.RECONCILE_SLICE, before)]
+
+    def _reconcile(self, now, ranges):
+        #ranges are (after, before, remote activities) tuples
+        if not ranges:
             return
-        if not self._run_update_cache:
+        for after, before, remote_activities in ranges:
+            self._reconcile_range(after, before, remote_activities)
+        oldest = self._cache.get_metadata('oldest_activity')
+        if oldest is None:
+            #caches created before the metadata were stored
+            oldest = self._get_oldest_timestamp(self._cache.get_activities())
+            self._cache.set_metadata('oldest_activity', oldest)
+        after = ranges[-1][0]
+        #start again from the recent activities once history is covered
+        self._cache.set_metadata('reconcile_before', after if after > oldest else None)
+        self._cache.set_metadata('reconciled_at', now)
+
+    def _update_cache(self):
+        now = time.time()
+        if self._cache_updated_at is not None and (
+                self._sync_interval is None or now - self._cache_updated_at < self._sync_interval):
             return
-        activities = self._cache.get_activities()
-        timestamp = self._get_latest_timestamp(activities)
-        logging.getLogger('CachedRepository').debug(
-                            "Newest activity in cache {}".format(timestamp))
-        new_activities = []
-        page = 1
-        while True:
-            logging.getLogger('CachedRepository').info(
-                    "Loading page {} of {} elements".format(page, CachedRepository.page_size))
-            curr_activities = self._client.get_activities_after(
-                                                timestamp, page, CachedRepository.page_size)
+        self._cache_updated_at = now
+        with metrics.phase('sync'), self.batch():
+            if not self._cache.is_initialized():
+                self._init_cache()
+                return
+            if not self._run_update_cache:
+                return
+            timestamp = self._cache.get_metadata('sync_cursor')
+            if timestamp is None:
+                #caches created before the cursor was stored
+                timestamp = self._get_latest_timestamp(self._cache.get_activities())
             logging.getLogger('CachedRepository').debug(
-                    "{} activities loaded".format(len(curr_activities)))
-            page += 1
-            new_activities.extend(curr_activities)
-            if len(curr_activities) < CachedRepository.page_size:
-                logging.getLogger('CachedRepository').debug(
-                                            "No more activities to load")
-                break
-        activities = self._merge_lists(activities, new_activities)
-        self._cache.update_activities(activities)
+                                "Newest activity in cache {}".format(timestamp))
+            new_activities = self._get_pages(
+                lambda page, per_page: self._client.get_activities_after(timestamp, page, per_page))
+            logging.getLogger('CachedRepository').debug("No more activities to load")
+            ranges = [(after, before, self._get_remote_range(after, before))
+                      for after, before in self._reconcile_ranges(now)]
+            #written after every api call, so that no transaction is open
+            #while waiting for them
+            with self._cache.batch():
+                self._store_activities(new_activities)
+                self._reconcile(now, ranges)
 
-    def get_activities(self):
+    def set_token(self, token):
+        self._client.set_token(token)
+
+    @contextlib.contextmanager
+    def batch(self):
+        #the cache is not included: its batches, which may hold a database
+        #transaction, only surround writes done after the api calls
+        with contextlib.ExitStack() as stack:
+            for index in self._indexes.values():
+                stack.enter_context(index.batch())
+            if self._aggregates is not None:
+                stack.enter_context(self._aggregates.batch())
+            for store in (self._stream_store, self._detail_store):
+                if store is not None:
+                    stack.enter_context(store.batch())
+            yield
+
+    def _get_index(self, name):
+        #indexes are built from the cache the first time they're needed
+        index = self._indexes.get(name)
+        if index is not None and not index.is_initialized():
+            index.rebuild(self._cache.get_activities())
+            if name == 'text' and self._detail_store is not None:
+                #descriptions only: the names of the details may be outdated
+                index.update(
+                    {'id': activity_detail['id'], 'description': activity_detail.get('description')}
+                    for activity_detail in self._detail_store.get_activity_details())
+        return index
+
+    def _update_indexes(self, activities, deleted_ids = ()):
+        #changes are ignored until an index is built
+        for index in self._indexes.values():
+            if not index.is_initialized():
+                continue
+            if activities:
+                index.update(activities)
+            if deleted_ids:
+                index.remove(deleted_ids)
+
+    def _search(self, predicate):
+        #resolves the predicates which can use an index, and returns the ids
+        #matching all of them (None if there are no such predicates)
+        result = None
+        for indexed_predicate in predicate.predicates():
+            if not isinstance(indexed_predicate, predicates.IndexedPredicate):
+                continue
+            index = self._get_index(indexed_predicate.index)
+            if index is None:
+                continue
+            ids = indexed_predicate.search(index)
+            indexed_predicate.resolve(ids)
+            result = ids if result is None else result & ids
+        return result
+
+    def get_activities(self, predicate = None):
         self._update_cache()
-        return self._cache.get_activities()
+        with metrics.phase('filter'):
+            if predicate is None:
+                return self._cache.get_activities()
+            ids = self._search(predicate)
+            if ids is not None:
+                return predicate.filter(self._cache.get_activities_by_ids(ids))
+            return self._cache.find_activities(predicate)
 
     def get_activity(self, id):
         self._update_cache()
         return self._cache.get_activity(id)
 
-    def get_activity_detail(self, id):
-        activity_detail = None
-        if not self._run_update_cache:
-            activity_detail = self._cache.get_activity_detail(id)
-        if activity_detail is None:
-            activity_detail = self._client.get_activity_detail(id)
-            self._cache.update_activity_detail(activity_detail)
-        return activity_detail
-
-    def get_gps(self, id):
-        streams = self._client.get_streams(id)
-        activity = self.get_activity(int(id))
-        start_time = int(parse_date(activity['start_date']).timestamp())
-        streams = zip(*(streams[key]['data'] if key in streams else [] for key in ('time', 'latlng', 'altitude')))
-        return activity, [(time + start_time, point, altitude) for time, point, altitude in streams]
+    def get_aggregates(self, rebuild = False):
+        #per period totals of all the activities; they are rebuilt when
+        #asked, or if they don't count as many activities as the cache
+        self._update_cache()
+        if self._aggregates is None:
+            return None
+        if (rebuild or not self._aggregates.is_initialized() or
+                self._aggregates.count() != self._cache.count_activities()):
+            logging.getLogger('CachedRepository').info("Rebuilding aggregates")
+            self._aggregates.rebuild(self._cache.get_activities())
+        return self._aggregates
+
+    def get_activity_details(self, ids, refresh = False):
+        #details are read from the detail store unless refresh is set; the
+        #missing ones are downloaded concurrently, the store is only accessed
+        #by the calling thread
+        cached = [None] * len(ids)
+        if self._detail_store is not None:
+            if not self._details_moved:
+                cache.move_activity_details(self._cache, self._detail_store)
+                self._details_moved = True
+            if not refresh:
+                cached = [self._detail_store.get(id) for id in ids]
+        downloaded = self._map(self._client.get_activity_detail,
+                               [id for id, activity_detail in zip(ids, cached) if activity_detail is None])
+        for activity_detail in cached:
+            if activity_detail is None:
+                with metrics.phase('download'):
+                    activity_detail = next(downloaded)
+                if self._detail_store is not None:
+                    self._detail_store.put(activity_detail)
+                self._update_indexes([activity_detail])
+            yield activity_detail
+
+    def get_routes(self, predicate = None):
+        #(activity, points) pairs decoded from the summary polylines of the
+        #cached activities, one at a time; activities without a polyline
+        #(e.g. indoor ones) are skipped
+        for activity in self.get_activities(predicate):
+            encoded = (activity.get('map') or {}).get('summary_polyline')
+            if encoded:
+                yield activity, polyline.decode(encoded)
+
+    def get_gps_tracks(self, ids, refresh = False):
+        #yields (activity, track) pairs. Tracks are read from the stream store
+        #unless refresh is set, one at a time as they are yielded, since every
+        #stored track keeps its file open; the missing ones are downloaded
+        #concurrently
+        stored = [False] * len(ids)
+        if self._stream_store is not None and not refresh:
+            stored = [self._stream_store.contains(id, CachedRepository.STREAM_TYPES) for id in ids]
+        downloaded = self._map(
+            lambda id: self._client.get_streams(id, CachedRepository.STREAM_TYPES),
+            [id for id, is_stored in zip(ids, stored) if not is_stored])
+        for id, is_stored in zip(ids, stored):
+            activity = self.get_activity(int(id))
+            track = self._stream_store.get(id, CachedRepository.STREAM_TYPES) if is_stored else None
+            if track is None:
+                start_time = int(parse_date(activity['start_date']).timestamp())
+                with metrics.phase('download'):
+                    #stored tracks removed in the meantime are downloaded here
+                    streams = next(downloaded) if not is_stored else self._client.get_streams(
+                        id, CachedRepository.STREAM_TYPES)
+                    track = GpsTrack.from_streams(start_time, streams)
+                if self._stream_store is not None:
+                    self._stream_store.put(id, CachedRepository.STREAM_TYPES, track)
+            yield activity, track
 
     def get_bikes(self):
         athlete = self._client.get_athlete()
@@ -142,20 +419,78 @@ class CachedRepository:
         athlete = self._client.get_athlete()
         return athlete["shoes"]
 
+    def _parse_value(self, current, value):
+        #values are strings from the command line: booleans are converted
+        #the way strava parses them, so the cache keeps the same types
+        if isinstance(current, bool) and value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        return value
+
     def _merge_activity(self, activity, data):
         for k, v in data.items():
             if k in activity:
-                activity[k] = v
+                activity[k] = self._parse_value(activity[k], v)
 
-    def update_activity(self, id, data):
+    def _is_unchanged(self, activity, data):
+        if activity is None:
+            return False
+        for k, v in data.items():
+            if k not in activity:
+                return False
+            current = activity[k]
+            value = self._parse_value(current, v)
+            if isinstance(current, bool) or current is None:
+                if current is not value:
+                    return False
+            elif str(current) != value:
+                return False
+        return True
+
+    def _put_activity(self, id, data):
+        try:
+            self._client.update_activity(id, **data)
+            return None
+        except Exception as e:
+            logging.getLogger('CachedRepository').exception(e)
+            return e
+
+    def update_activities(self, ids, data):
+        #returns (id, status, error) tuples, in order, where status is one of
+        #UPDATED, UNCHANGED or FAILED and error is set for the failed ones
         logging.getLogger('CachedRepository').info(
-                    "Updating activity {} with data {}".format(id, data))
-        self._client.update_activity(id, **data)
-        activity = self._cache.get_activity(id)
-        if activity is not None:
-            self._merge_activity(activity, data)
-            self._cache.update_activity(activity)
+                    "Updating activities {} with data {}".format(ids, data))
+        activities = {id: self._cache.get_activity(id) for id in ids}
+        to_update = [id for id in ids if not self._is_unchanged(activities[id], data)]
+        errors = dict(zip(to_update, self._map(lambda id: self._put_activity(id, data), to_update)))
+        results = []
+        with self.batch(), self._cache.batch():
+            for id in ids:
+                if id not in errors:
+                    results.append((id, CachedRepository.UNCHANGED, None))
+                    continue
+                if errors[id] is not None:
+                    results.append((id, CachedRepository.FAILED, errors[id]))
+                    continue
+                if self._detail_store is not None:
+                    self._detail_store.delete([id])
+                activity = activities[id]
+                if activity is not None:
+                    if self._aggregates_initialized():
+                        self._aggregates.add([activity], -1)
+                    self._merge_activity(activity, data)
+                    self._cache.update_activity(activity)
+                    self._update_indexes([activity])
+                    if self._aggregates_initialized():
+                        self._aggregates.add([activity])
+                results.append((id, CachedRepository.UPDATED, None))
+        return results
 
 
-def get_repository(token, update_cache = True, sleep = None):
-    return CachedRepository(token, cache.get_cache(), update_cache, sleep)
+def get_repository(token, update_cache = True, sleep = None,
+                   pool_size = api.DEFAULT_POOL_SIZE, jobs = 1,
+                   details_max_count = cache.DetailStore.DEFAULT_MAX_COUNT, details_ttl = None):
+    return CachedRepository(token, cache.get_cache(), update_cache, sleep, pool_size, jobs,
+                            cache.get_stream_store(), None,
+                            cache.get_detail_store(details_max_count, details_ttl),
+                            cache.get_text_index(), cache.get_spatial_index(),
+                            cache.get_aggregates())
@@ -0,0 +1,224 @@
+import array
+import datetime
+import indexes
+import itertools
+import operator
+
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def parse_date(date_str):
+    #fast path for the dates stored in the activities (YYYY-MM-DDTHH:MM:SSZ):
+    #returns (days since epoch, seconds since epoch, year * 12 + month - 1)
+    year, month, day = int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10])
+    days = datetime.date(year, month, day).toordinal() - EPOCH_ORDINAL
+    seconds = days * 86400 + int(date_str[11:13]) * 3600 + int(date_str[14:16]) * 60 + int(date_str[17:19])
+    return days, seconds, year * 12 + month - 1
+
+
+def week_key(days):
+    #1970-01-01 was a thursday: weeks are numbered from monday
+    return (days + 3) // 7
+
+
+def period_label(group_by, key):
+    if group_by == 'week':
+        year, week, _ = datetime.date.fromordinal(key * 7 - 3 + EPOCH_ORDINAL).isocalendar()
+        return '{}-W{:02}'.format(year, week)
+    if group_by == 'month':
+        return '{}-{:02}'.format(key // 12, key % 12 + 1)
+    return str(key)
+
+
+def group_row(label, count, distance, moving_time, total_elevation_gain):
+    return {
+        'group': label,
+        'count': count,
+        'distance': distance,
+        'mean_distance': distance / count,
+        'moving_time': moving_time,
+        'total_elevation_gain': total_elevation_gain,
+    }
+
+
+class ActivityTable(object):
+    #columnar view of the activities, filtered with per-column masks
+
+    OPERATORS = {'=': operator.eq, '<': operator.lt, '>': operator.gt}
+
+    GROUPS = ('type', 'week', 'month', 'year')
+
+    COLUMNS = ('distance', 'moving_time', 'total_elevation_gain', 'type', 'trainer', 'private',
+               'start_date', 'start_date_local')
+
+    def __init__(self, activities, utc = False):
+        self._types = []
+        type_codes = {}
+        columns = {
+            'distance': array.array('d'),
+            'moving_time': array.array('d'),
+            'total_elevation_gain': array.array('d'),
+            'type': array.array('i'),
+            'trainer': array.array('b'),
+            'private': array.array('b'),
+            'start_date': array.array('q'),
+            'start_date_local': array.array('q'),
+        }
+        days = array.array('i')
+        months = array.array('i')
+        for activity in activities:
+            columns['distance'].append(activity.get('distance') or 0)
+            columns['moving_time'].append(activity.get('moving_time') or 0)
+            columns['total_elevation_gain'].append(activity.get('total_elevation_gain') or 0)
+            activity_type = activity.get('type')
+            if activity_type not in type_codes:
+                type_codes[activity_type] = len(self._types)
+                self._types.append(activity_type)
+            columns['type'].append(type_codes[activity_type])
+            columns['trainer'].append(bool(activity.get('trainer')))
+            columns['private'].append(bool(activity.get('private')))
+            utc_days, utc_seconds, utc_month = parse_date(activity['start_date'])
+            columns['start_date'].append(utc_seconds)
+            local_days, local_seconds, local_month = parse_date(activity['start_date_local'])
+            columns['start_date_local'].append(local_seconds)
+            days.append(utc_days if utc else local_days)
+            months.append(utc_month if utc else local_month)
+        self._columns = columns
+        self._type_codes = type_codes
+        self._days = days
+        self._months = months
+
+    def __len__(self):
+        return len(self._days)
+
+    def _column_value(self, name, value):
+        if name in ('start_date', 'start_date_local'):
+            return parse_date(value)[1]
+        if name == 'type':
+            return self._type_codes.get(value, -1)
+        return value
+
+    @staticmethod
+    def can_filter(predicate):
+        return predicate.exact and all(
+            name in ActivityTable.COLUMNS and op in ActivityTable.OPERATORS
+            for name, op, value in predicate.constraints())
+
+    def mask(self, predicate):
+        mask = bytearray(b'\x01') * len(self)
+        for name, op, value in predicate.constraints():
+            column = self._columns[name]
+            value = self._column_value(name, value)
+            column_mask = map(ActivityTable.OPERATORS[op], column, itertools.repeat(value, len(column)))
+            mask = bytearray(map(operator.and_, mask, column_mask))
+        return mask
+
+    def _group_keys(self, group_by):
+        if group_by == 'type':
+            return self._columns['type']
+        if group_by == 'week':
+            return array.array('i', map(week_key, self._days))
+        if group_by == 'month':
+            return self._months
+        if group_by == 'year':
+            return array.array('i', (month // 12 for month in self._months))
+        raise ValueError("Invalid group {}".format(group_by))
+
+    def _group_label(self, group_by, key):
+        if group_by == 'type':
+            return self._types[key]
+        return period_label(group_by, key)
+
+    def group(self, group_by, mask = None):
+        indexes = range(len(self))
+        if mask is not None:
+            indexes = itertools.compress(indexes, mask)
+        keys = self._group_keys(group_by)
+        groups = {}
+        for index in indexes:
+            groups.setdefault(keys[index], []).append(index)
+        sort_key = (lambda key: self._types[key] or '') if group_by == 'type' else None
+        for key in sorted(groups, key=sort_key):
+            rows = groups[key]
+            yield group_row(
+                self._group_label(group_by, key), len(rows),
+                sum(map(self._columns['distance'].__getitem__, rows)),
+                sum(map(self._columns['moving_time'].__getitem__, rows)),
+                sum(map(self._columns['total_elevation_gain'].__getitem__, rows)))
+
+
+class Aggregates(indexes.JsonIndex):
+    #count, distance, moving time and elevation gain per type and ISO week,
+    #month and year (local dates) of all the activities, stored as a json
+    #file. They are updated by adding and subtracting the activities which
+    #change, instead of being computed from all of them
+
+    PERIODS = ('week', 'month', 'year')
+
+    #rounding of the totals, so that additions and subtractions don't drift
+    DIGITS = 6
+
+    def _empty(self):
+        return {'count': 0, 'totals': {period: {} for period in Aggregates.PERIODS}}
+
+    def _from_json(self, data):
+        return {'count': data['count'], 'totals': {
+            period: {(row[0], row[1]): row[2:] for row in data[period]} for period in Aggregates.PERIODS}}
+
+    def _to_json(self):
+        data = self._get_document()
+        result = {'count': data['count']}
+        for period, totals in data['totals'].items():
+            result[period] = [list(key) + values for key, values in totals.items()]
+        return result
+
+    def _keys(self, activity):
+        days, _, month = parse_date(activity['start_date_local'])
+        return {'week': week_key(days), 'month': month, 'year': month // 12}
+
+    def add(self, activities, sign = 1):
+        #sign -1 subtracts the activities, before they are changed or deleted;
+        #copies are kept, as they may be changed before the file is written
+        self._change('_add', [dict(activity) for activity in activities], sign)
+
+    def _add(self, activities, sign = 1):
+        data = self._get_document()
+        for activity in activities:
+            values = (sign, sign * (activity.get('distance') or 0), sign * (activity.get('moving_time') or 0),
+                      sign * (activity.get('total_elevation_gain') or 0))
+            for period, key in self._keys(activity).items():
+                totals = data['totals'][period]
+                row_key = (activity.get('type'), key)
+                row = totals.setdefault(row_key, [0, 0, 0, 0])
+                for i, value in enumerate(values):
+                    row[i] = round(row[i] + value, Aggregates.DIGITS)
+                if row[0] <= 0:
+                    del totals[row_key]
+            data['count'] += sign
+
+    def _update(self, activities):
+        self._add(activities)
+
+    def count(self):
+        return self._get_document()['count']
+
+    def group(self, group_by):
+        #same rows of ActivityTable.group for all the activities
+        totals = self._get_document()['totals']['year' if group_by == 'type' else group_by]
+        groups = {}
+        for (activity_type, key), values in totals.items():
+            group = groups.setdefault(activity_type if group_by == 'type' else key, [0, 0, 0, 0])
+            for i, value in enumerate(values):
+                group[i] += value
+        sort_key = (lambda key: key or '') if group_by == 'type' else None
+        for key in sorted(groups, key=sort_key):
+            label = key if group_by == 'type' else period_label(group_by, key)
+            yield group_row(label, *groups[key])
+
+
+def get_stats(activities, predicate, group_by, utc = False):
+    if ActivityTable.can_filter(predicate):
+        table = ActivityTable(activities, utc)
+        return table.group(group_by, table.mask(predicate))
+    return ActivityTable(predicate.filter(activities), utc).group(group_by)
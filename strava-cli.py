@@ -3,18 +3,28 @@
 import auth
 import argparse
 import config
+import api
 import repository
 import predicates
 import formatters
 import cache
+import stats
+import daemon
+import metrics
+import contextlib
+import signal
+import json
 import logging
+import sys
 
 
-logging.basicConfig(
-    filename=config.get_log_file(),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
-)
+def configure_logging():
+    #the log file is opened only when the first record is written
+    logging.basicConfig(
+        handlers=[logging.FileHandler(config.get_log_file(), delay=True)],
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.DEBUG
+    )
 
 
 def authenticate(args):
@@ -22,23 +32,105 @@ def authenticate(args):
     a.authorize(args.client_id, args.client_secret)
 
 
+class WarmState(object):
+    #token, cache and repositories kept in memory by the daemon
+
+    #seconds between checks for new activities
+    SYNC_INTERVAL = 60
+
+    def __init__(self):
+        self.token_provider = auth.access_token_provider()
+        self.cache = cache.get_cache()
+        self.stream_store = cache.get_stream_store()
+        self.text_index = cache.get_text_index()
+        self.spatial_index = cache.get_spatial_index()
+        self.aggregates = cache.get_aggregates()
+        self.repositories = {}
+
+    def refresh(self):
+        #picks up the changes made by the commands not run by the daemon
+        self.cache.refresh()
+        for index in (self.text_index, self.spatial_index, self.aggregates):
+            index.refresh()
+
+
+#set when running as a daemon
+warm_state = None
+
+
 def get_token(args):
-    tkn = auth.access_token_provider().get_access_token()
+    provider = warm_state.token_provider if warm_state is not None else auth.access_token_provider()
+    with metrics.phase('token'):
+        tkn = provider.get_access_token()
     if tkn is None:
         logging.getLogger('get_token').error("No token specified - aborting")
-        import sys
         print("Cannot find a token - please authenticate")
         sys.exit(1)
     return tkn
 
 
+def get_details_ttl(args):
+    return args.details_ttl * 3600 if args.details_ttl is not None else None
+
+
+def get_repository(args, update_cache = True):
+    if warm_state is None:
+        return repository.get_repository(get_token(args), update_cache, args.sleep,
+                                         args.pool_size, args.jobs, args.details_max,
+                                         get_details_ttl(args))
+    key = (update_cache, args.sleep, args.pool_size, args.jobs, args.details_max, args.details_ttl)
+    if key not in warm_state.repositories:
+        warm_state.repositories[key] = repository.CachedRepository(
+            get_token(args), warm_state.cache, update_cache, args.sleep, args.pool_size,
+            args.jobs, warm_state.stream_store, WarmState.SYNC_INTERVAL,
+            cache.get_detail_store(args.details_max, get_details_ttl(args)), warm_state.text_index,
+            warm_state.spatial_index, warm_state.aggregates)
+    r = warm_state.repositories[key]
+    r.set_token(get_token(args))
+    return r
+
+
 def list_activities(args):
-    r = repository.get_repository(get_token(args), args.update_cache, args.sleep)
+    r = get_repository(args, args.update_cache)
     p = predicates.get_predicate_from_filters(args.utc, args.filter)
     f = formatters.get_formatter(args.json, args.quiet, args.verbose, args.utc)
-    for activity in r.get_activities():
-        if p.matches(activity):
-            print(f.format(activity))
+    with formatters.BufferedWriter() as out:
+        activities = r.get_activities(p)
+        with metrics.phase('format'):
+            for activity in activities:
+                out.writeline(f.format(activity))
+
+
+def activities_stats(args):
+    r = get_repository(args, args.update_cache)
+    p = predicates.get_predicate_from_filters(args.utc, args.filter)
+    #totals of all the activities in local time are kept by the repository
+    aggregates = r.get_aggregates(args.rebuild) if args.filter is None and not args.utc else None
+    if aggregates is not None:
+        with metrics.phase('stats'):
+            groups = list(aggregates.group(args.group_by))
+    else:
+        #predicates that the stats can't evaluate on columns are applied by
+        #the repository, which can use the indexes
+        activities = r.get_activities(None if stats.ActivityTable.can_filter(p) else p)
+        with metrics.phase('stats'):
+            groups = list(stats.get_stats(activities, p, args.group_by, args.utc))
+    for group in groups:
+        if args.json:
+            print(json.dumps(group))
+        else:
+            print('{group:<12}\t{count}\t{distance:.1f}\t{mean_distance:.1f}\t'
+                  '{moving_time:.0f}\t{total_elevation_gain:.1f}'.format(**group))
+
+
+def get_ids(args):
+    ids = []
+    for id in args.id:
+        if not id.isdigit():
+            print('activity {} needs to be a number'.format(id))
+            continue
+        ids.append(int(id))
+    return ids
 
 
 def get_update_data(args):
@@ -52,44 +144,70 @@ def get_update_data(args):
 
 
 def update_activities(args):
-    r = repository.get_repository(get_token(args), sleep=args.sleep)
+    r = get_repository(args)
     data = get_update_data(args)
-    for id in args.id:
-        if not id.isdigit():
-            print('activity {} needs to be a number'.format(id))
-            continue
-        r.update_activity(int(id), data)
+    failed = False
+    with r.batch():
+        for id, status, error in r.update_activities(get_ids(args), data):
+            if error is not None:
+                failed = True
+                print('{}\t{}\t{}'.format(id, status, error))
+            else:
+                print('{}\t{}'.format(id, status))
+    if failed:
+        sys.exit(1)
 
 
 def activities_details(args):
-    r = repository.get_repository(get_token(args), args.update_cache, args.sleep)
+    r = get_repository(args, args.update_cache)
     f = formatters.get_formatter_details(args.json, args.quiet, args.verbose, args.utc)
-    for id in args.id:
-        if not id.isdigit():
-            print('activity {} needs to be a number'.format(id))
-            continue
-        activity = r.get_activity_detail(int(id))
-        print(f.format(activity) if activity is not None else 'activity {} not found'.format(id))
+    ids = get_ids(args)
+    with r.batch(), metrics.phase('format'):
+        for id, activity in zip(ids, r.get_activity_details(ids, args.refresh)):
+            print(f.format(activity) if activity is not None else 'activity {} not found'.format(id))
 
 
 def activities_gps(args):
-    r = repository.get_repository(get_token(args), args.update_cache, args.sleep)
-    f = formatters.get_formatter_gps(args.json)
-    for id in args.id:
-        if not id.isdigit():
-            print('activity {} needs to be a number'.format(id))
-            continue
-        print(f.format(*r.get_gps(int(id))))
+    r = get_repository(args, args.update_cache)
+    f = formatters.get_formatter_gps(args.json, args.ndjson)
+    with r.batch(), formatters.BufferedWriter() as out, metrics.phase('format'):
+        for gps in r.get_gps_tracks(get_ids(args), args.refresh):
+            for chunk in f.chunks(*gps):
+                out.write(chunk)
+            out.write('\n')
+
+
+def export_activities(args):
+    r = get_repository(args, args.update_cache)
+    p = predicates.get_predicate_from_filters(args.utc, args.filter)
+    routes = r.get_routes(p)
+    if args.format == 'gpx':
+        #one file per activity, compressed as they are written
+        import zipfile
+        f = formatters.GpxFormatter()
+        with zipfile.ZipFile(args.output or sys.stdout.buffer, 'w', zipfile.ZIP_DEFLATED) as archive, \
+                metrics.phase('format'):
+            for activity, points in routes:
+                with archive.open('{}.gpx'.format(activity['id']), 'w') as entry:
+                    for chunk in f.route_chunks(activity, points):
+                        entry.write(chunk.encode('utf-8'))
+        return
+    f = formatters.GeoJsonFormatter()
+    with (open(args.output, 'w', encoding='utf-8') if args.output else contextlib.nullcontext(sys.stdout)) as stream, \
+            formatters.BufferedWriter(stream) as out, metrics.phase('format'):
+        for chunk in f.chunks(routes):
+            out.write(chunk)
+        out.write('\n')
 
 
 def list_bikes(args):
-    r = repository.get_repository(get_token(args), sleep=args.sleep)
+    r = get_repository(args)
     for bike in r.get_bikes():
         print('{id:<20} {name:<20}'.format(**bike))
 
 
 def list_shoes(args):
-    r = repository.get_repository(get_token(args), sleep=args.sleep)
+    r = get_repository(args)
     for shoe in r.get_shoes():
         print('{id:<20} {name:<20}'.format(**shoe))
 
@@ -97,14 +215,79 @@ def list_shoes(args):
 def clear_cache(args):
     logging.getLogger('clear_cache').info("Clearing cache")
     cache.get_cache().clear()
-
-
-if __name__ == "__main__":
+    cache.get_stream_store().clear()
+    cache.get_detail_store().clear()
+    cache.get_text_index().clear()
+    cache.get_spatial_index().clear()
+    cache.get_aggregates().clear()
+
+
+def migrate_cache(args):
+    logging.getLogger('migrate_cache').info("Migrating cache to SQLite")
+    cache.migrate_to_sqlite()
+
+
+def run_daemon(args):
+    global warm_state
+    parser = build_parser()
+    warm_state = WarmState()
+
+    def run_command(argv, out):
+        global warm_state
+        command_args = None
+        try:
+            #argparse errors exit, printing the usage to stderr
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                command_args = parser.parse_args(argv)
+            warm_state.refresh()
+            with contextlib.redirect_stdout(out):
+                command_args.func(command_args)
+            return 0
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else int(e.code is not None)
+        finally:
+            if command_args is not None and command_args.func in (clear_cache, migrate_cache):
+                warm_state = WarmState()
+
+    path = daemon.get_socket_path()
+    print("Listening on {}. Press CTRL-C to stop".format(path))
+    #exit cleanly on kill, so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.Server(path, run_command).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+#commands never sent to the daemon: export writes files and binary output
+LOCAL_COMMANDS = (authenticate, run_daemon, export_activities)
+
+
+def build_parser():
     parser = argparse.ArgumentParser(
                         description='Strava Command Line Interface')
     parser.set_defaults(func=lambda args: parser.print_help())
     parser.add_argument('--sleep', '-s', type=int,
-                            help='Sleep between every api call')
+                            help='Minimum time between api calls; by default '
+                            'requests are throttled only near the rate limits')
+    parser.add_argument('--pool-size', type=int, default=api.DEFAULT_POOL_SIZE,
+                            help='Maximum number of HTTP connections kept alive')
+    parser.add_argument('--jobs', '-J', type=int, default=1,
+                            help='Number of concurrent api calls (pages, details, gps)')
+    parser.add_argument('--details-max', type=int, default=cache.DetailStore.DEFAULT_MAX_COUNT,
+                            help='Maximum number of activity details kept in the cache')
+    parser.add_argument('--details-ttl', type=float,
+                            help='Hours after which cached activity details are downloaded again')
+    parser.add_argument('--no-daemon', dest='daemon', action='store_false',
+                            help='Run the command in this process even if the daemon is running')
+    parser.add_argument('--metrics', action='store_true',
+                            help='Report time per phase, api calls and cache counters to stderr; '
+                            'the command runs in this process')
+    parser.add_argument('--metrics-file', metavar='FILE',
+                            help='Same as --metrics, writing the report to FILE as JSON')
+    parser.add_argument('--profile', metavar='FILE',
+                            help='Write cProfile statistics of the command to FILE; '
+                            'the command runs in this process')
     subparsers = parser.add_subparsers()
 
     parser_list = subparsers.add_parser('activities', help='List activities '
@@ -123,6 +306,22 @@ if __name__ == "__main__":
                              help='Update the internal cache.  This is the default.')
     parser_list.set_defaults(func=list_activities)
 
+    parser_stats = subparsers.add_parser('stats', help='Totals of the activities '
+                                         'matching the specified filters')
+    parser_stats.add_argument('--filter', '-f', action='append',
+                              help='Adds a filter to the query')
+    parser_stats.add_argument('--group-by', '-g', choices=stats.ActivityTable.GROUPS,
+                              default='type', help='Group activities by type or period')
+    parser_stats.add_argument('--json', '-j', action='store_true',
+                              help='Output in JSON format')
+    parser_stats.add_argument('--utc', '-u', action='store_true',
+                              help='Use the UTC time zone')
+    parser_stats.add_argument('--update-cache', '-c', type=lambda s: s.lower() in ['true', 'yes'], default=True,
+                              help='Update the internal cache.  This is the default.')
+    parser_stats.add_argument('--rebuild', action='store_true',
+                              help='Compute the totals again from the cached activities')
+    parser_stats.set_defaults(func=activities_stats)
+
     parser_details = subparsers.add_parser('details', help='Retrieves the '
                                            'details of one or more activities')
     parser_details.add_argument('--quiet', '-q', action='store_true',
@@ -135,6 +334,8 @@ if __name__ == "__main__":
                              help='Prints more information about the activity')
     parser_details.add_argument('--update-cache', '-c', type=lambda s: s.lower() in ['true', 'yes'], default=True,
                              help='Update the internal cache.  This is the default.')
+    parser_details.add_argument('--refresh', '-r', action='store_true',
+                             help='Download the details again instead of using the cached ones')
     parser_details.add_argument('id',
                                 nargs='+', help='Activity id(s)')
     parser_details.set_defaults(func=activities_details)
@@ -143,12 +344,30 @@ if __name__ == "__main__":
                                            'gps file of one or more activities')
     parser_gps.add_argument('--json', '-j', action='store_true',
                              help='Output in JSON format')
+    parser_gps.add_argument('--ndjson', '-n', action='store_true',
+                             help='Output the activity and then one point per line, in JSON format')
+    parser_gps.add_argument('--refresh', '-r', action='store_true',
+                             help='Download the tracks even if they are cached')
     parser_gps.add_argument('id',
                                 nargs='+', help='Activity id(s)')
     parser_gps.add_argument('--update-cache', '-c', type=lambda s: s.lower() in ['true', 'yes'], default=True,
                              help='Update the internal cache.  This is the default.')
     parser_gps.set_defaults(func=activities_gps)
 
+    parser_export = subparsers.add_parser('export', help='Exports the routes of the activities '
+                                          'matching the specified filters, without api calls')
+    parser_export.add_argument('--filter', '-f', action='append',
+                             help='Adds a filter to the query')
+    parser_export.add_argument('--format', choices=('geojson', 'gpx'), default='geojson',
+                             help='A GeoJSON FeatureCollection (default) or a zip of GPX files')
+    parser_export.add_argument('--output', '-o',
+                             help='Output file (default: stdout)')
+    parser_export.add_argument('--utc', '-u', action='store_true',
+                             help='Use the UTC time zone in the date filters')
+    parser_export.add_argument('--update-cache', '-c', type=lambda s: s.lower() in ['true', 'yes'], default=False,
+                             help='Check for new activities first.  By default only the cache is used.')
+    parser_export.set_defaults(func=export_activities)
+
     parser_update = subparsers.add_parser('update',
                                           help='Update one or more activities')
     parser_update.add_argument('--set', '-s', action='append',
@@ -166,6 +385,10 @@ if __name__ == "__main__":
                                                help='Clear the cache')
     parser_clear_cache.set_defaults(func=clear_cache)
 
+    parser_migrate_cache = subparsers.add_parser('migrate-cache',
+                                                 help='Move the cache to a SQLite database')
+    parser_migrate_cache.set_defaults(func=migrate_cache)
+
     parser_auth = subparsers.add_parser('authenticate', help='Authenticate '
                                         'using a client secret and client id')
     parser_auth.add_argument('--port', '-p', type=int,
@@ -176,6 +399,34 @@ if __name__ == "__main__":
                              required=True, help='Strava Client Secret')
     parser_auth.set_defaults(func=authenticate)
 
-    args = parser.parse_args()
+    parser_daemon = subparsers.add_parser('daemon', help='Run in the background, '
+                                          'keeping cache and connections ready for the other commands')
+    parser_daemon.set_defaults(func=run_daemon)
+
+    return parser
 
-    args.func(args)
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    configure_logging()
+    #metrics and profiles are about the work done in this process
+    metrics_output = args.metrics_file or ('-' if args.metrics else None)
+    local = args.func in LOCAL_COMMANDS or metrics_output or args.profile
+    if args.daemon and not local:
+        code = daemon.run(daemon.get_socket_path(), sys.argv[1:], sys.stdout)
+        if code is not None:
+            sys.exit(code)
+    if metrics_output:
+        metrics.enable()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        args.func(args)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if metrics_output:
+            metrics.get().write(metrics_output)
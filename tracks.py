@@ -0,0 +1,98 @@
+import array
+import itertools
+import mmap
+import struct
+import sys
+
+
+class GpsTrack(object):
+    #compact columnar encoding of a gps track. Layout (little endian):
+    #header (magic, number of points, absolute time of the first point),
+    #then time deltas (int32), latitudes and longitudes (int32, fixed point
+    #1e-7 degrees) and altitudes (float32). The buffer can be a memory
+    #mapped file, points are decoded only while iterating
+
+    MAGIC = b'GPS1'
+    HEADER = struct.Struct('<4sIq')
+    SCALE = 10 ** 7
+    #the binary layout is little endian, while memoryview casts are native
+    NATIVE = sys.byteorder == 'little'
+
+    def __init__(self, buffer):
+        magic, count, start_time = GpsTrack.HEADER.unpack_from(buffer)
+        if magic != GpsTrack.MAGIC:
+            raise ValueError("Invalid track data")
+        self._buffer = buffer
+        self._count = count
+        self._start_time = start_time
+        view = memoryview(buffer)[GpsTrack.HEADER.size:]
+        size = 4 * count
+        self._deltas = self._column(view[0:size], 'i')
+        self._latitudes = self._column(view[size:2 * size], 'i')
+        self._longitudes = self._column(view[2 * size:3 * size], 'i')
+        self._altitudes = self._column(view[3 * size:4 * size], 'f')
+
+    def _column(self, view, typecode):
+        if GpsTrack.NATIVE:
+            return view.cast(typecode)
+        column = array.array(typecode, view.tobytes())
+        column.byteswap()
+        return column
+
+    @staticmethod
+    def encode(start_time, times, points, altitudes):
+        #times are seconds from start_time, as in strava time streams
+        samples = list(zip(times, points, altitudes))
+        deltas = array.array('i')
+        latitudes = array.array('i')
+        longitudes = array.array('i')
+        elevations = array.array('f')
+        previous = 0
+        for time, point, altitude in samples:
+            deltas.append(time - previous)
+            previous = time
+            latitudes.append(round(point[0] * GpsTrack.SCALE))
+            longitudes.append(round(point[1] * GpsTrack.SCALE))
+            elevations.append(altitude)
+        columns = (deltas, latitudes, longitudes, elevations)
+        if not GpsTrack.NATIVE:
+            for column in columns:
+                column.byteswap()
+        return (GpsTrack.HEADER.pack(GpsTrack.MAGIC, len(samples), start_time) +
+                b''.join(column.tobytes() for column in columns))
+
+    @staticmethod
+    def from_streams(start_time, streams):
+        return GpsTrack(GpsTrack.encode(start_time, *(
+            streams[key]['data'] if key in streams else [] for key in ('time', 'latlng', 'altitude'))))
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as infile:
+            return GpsTrack(mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def to_bytes(self):
+        return bytes(self._buffer)
+
+    def __len__(self):
+        return self._count
+
+    def times(self):
+        return (self._start_time + time for time in itertools.accumulate(self._deltas))
+
+    def latitudes(self):
+        return (latitude / GpsTrack.SCALE for latitude in self._latitudes)
+
+    def longitudes(self):
+        return (longitude / GpsTrack.SCALE for longitude in self._longitudes)
+
+    def altitudes(self):
+        #float32 values, rounded to what the altitude stream contains
+        return (round(altitude, 2) for altitude in self._altitudes)
+
+    def __iter__(self):
+        #(time, (latitude, longitude), altitude) tuples, as returned before
+        #tracks were encoded
+        for time, latitude, longitude, altitude in zip(
+                self.times(), self.latitudes(), self.longitudes(), self.altitudes()):
+            yield time, (latitude, longitude), altitude
@@ -1,6 +1,158 @@
+import contextlib
 import datetime
+import fcntl
+import json
+import os
+import os.path
+import tempfile
 
 
 def parse_date(date_str):
     return datetime.datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
 
+
+@contextlib.contextmanager
+def file_lock(path):
+    #exclusive advisory lock between processes, held until the block ends.
+    #The lock file is never removed, so that every process locks the same file
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def file_version(file):
+    #path or file descriptor; changes when the file is replaced, None if it
+    #doesn't exist
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class Batched(object):
+    #changes made inside batch are flushed once, at the end of the outermost
+    #block; subclasses call _changed after every change and implement _flush
+
+    def __init__(self):
+        self._batch_depth = 0
+        self._dirty = False
+
+    def _flush(self):
+        raise NotImplementedError
+
+    def _changed(self):
+        if self._batch_depth > 0:
+            self._dirty = True
+        else:
+            self._flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            #flush even when the block fails, so completed changes are kept
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._dirty:
+                self._dirty = False
+                self._flush()
+
+
+class JsonDocument(Batched):
+    #json file shared by several processes. The file is replaced atomically,
+    #so readers always load a complete version without locking. Changes are
+    #made with _change, which applies them in memory and keeps them until
+    #they are written: writers take a lock and, if another process replaced
+    #the file since it was loaded, apply them again on the newer version
+    #instead of overwriting it
+
+    def __init__(self, path):
+        super().__init__()
+        self._path = path
+        self._document = None
+        #version of the file that was loaded and changes made since then
+        self._version = None
+        self._pending = []
+
+    def _lock_file(self):
+        return self._path + '.lock'
+
+    def _empty(self):
+        return {}
+
+    def _from_json(self, data):
+        return data
+
+    def _to_json(self):
+        return self._get_document()
+
+    def _reset(self):
+        #drops what is derived from the document
+        pass
+
+    def _load(self):
+        try:
+            infile = open(self._path)
+        except FileNotFoundError:
+            self._version = None
+            return self._empty()
+        with infile:
+            self._version = file_version(infile.fileno())
+            return self._from_json(json.load(infile))
+
+    def _get_document(self):
+        if self._document is None:
+            self._document = self._load()
+        return self._document
+
+    def _unload(self):
+        self._document = None
+        self._reset()
+
+    def _change(self, operation, *args):
+        #operation is the name of the method applying the change
+        getattr(self, operation)(*args)
+        self._pending.append((operation, args))
+        self._changed()
+
+    def _merge(self):
+        #applies the pending changes on the version written by another process
+        pending = self._pending
+        self._unload()
+        for operation, args in pending:
+            getattr(self, operation)(*args)
+
+    def _flush(self):
+        directory = os.path.dirname(self._path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with file_lock(self._lock_file()):
+            if file_version(self._path) != self._version:
+                self._merge()
+            with tempfile.NamedTemporaryFile(dir=directory, mode='w', delete=False) as outfile:
+                json.dump(self._to_json(), outfile)
+            os.replace(outfile.name, self._path)
+            self._version = file_version(self._path)
+        self._pending = []
+
+    def refresh(self):
+        #drops the document if another process changed the file, returning
+        #True if it did
+        if self._document is not None and not self._pending and file_version(self._path) != self._version:
+            self._unload()
+            return True
+        return False
+
+    def _delete_file(self):
+        with file_lock(self._lock_file()):
+            if os.path.exists(self._path):
+                os.remove(self._path)
+        self._unload()
+        self._dirty = False
+        self._version = None
+        self._pending = []